@@ -12,13 +12,21 @@ import psutil
 import shutil
 import threading
 import subprocess
-import numpy as np
 import tkinter as tk
 from PIL import Image
 from pathlib import Path
-from pyzbar import pyzbar
 import customtkinter as ctk
 from tkinter import Menu, filedialog, ttk, messagebox
+from marple_config import load_config, save_config
+from marple_metadata import MetadataCompactor, compact_metadata
+from marple_upload import stage_workspace, format_stage_report
+from marple_minknow import get_experiment_index, describe_index, format_barcode
+from marple_fastq import format_stats, format_filter_summary
+from marple_scanner import BarcodeScanner, CameraRegistry, SCAN_TIMEOUT, format_scan_stats
+from marple_scanner import photo_files, decode_photos, photo_barcode, photo_codes
+from marple_snakemake import SnakemakeLog, SnakemakeProgress, new_log_file, events_path, format_run_progress, format_job_table, DRAIN_INTERVAL, TABLE_INTERVAL
+from marple_snakemake import plan_run, record_run, snakemake_command, run_profile, format_profile
+from marple_transfer import TransferEngine, TransferProgress, FollowTransfer, transfer_samples, sample_output_file, summarise_results, format_progress, make_throttle
 
 class App(ctk.CTk):
     def __init__(self):
@@ -30,6 +38,8 @@ class App(ctk.CTk):
 
         self.marpledir = os.path.join(os.path.join(Path.home(), 'marple'))
         self.marpleguidir = os.path.join(os.path.join(Path.home(), 'marple-gui-dev'))
+        self.config_data = load_config(self.marpledir)
+        self.metadata_compactor = MetadataCompactor(self.marpledir, after=self.stage_uploads)
         
         self.geometry("920x1020")
         self.title("MARPLE")
@@ -43,14 +53,21 @@ class App(ctk.CTk):
         self.minknow_dir = ""
         
         # Barcode scanner variables
-        self.scanner_running = False
+        self.scanner = None
+        # Probe cameras now so scanning does not have to
+        self.camera_registry = CameraRegistry()
+        self.camera_registry.start()
         self.lock = threading.Lock()
         
-        # Hold output lines
-        self.output_lines = []
+        # Snakemake output of the current run, see drain_output
+        self.snakemake_log = None
         ## Output text initialization
         self.output_text = ctk.CTkTextbox(self, width=600, height=500)
         self.output_text.configure(state="disabled")
+        # Steps done, ETA and the wall time of each job
+        self.run_status_label = ctk.CTkLabel(self, text="", font=self.font)
+        self.job_table = ctk.CTkTextbox(self, width=600, height=160, font=ctk.CTkFont(family="Courier", size=13))
+        self.job_table.configure(state="disabled")
         
         logo_path = os.path.join(self.marpleguidir, "MARPLE_logo.png")
         try:
@@ -80,6 +97,51 @@ class App(ctk.CTk):
         self.menu_bar.add_cascade(label="Settings", menu=self.theme_menu)
         self.theme_menu.add_command(label=f'{"Dark mode" if self.colmode == "light" else "Light mode"}', command=self.switch_mode)
 
+        # Number of barcodes transferred at the same time
+        self.workers_var = tk.IntVar(value=self.config_data["transfer_workers"])
+        self.workers_menu = Menu(self.theme_menu, tearoff=0)
+        self.theme_menu.add_cascade(label="Transfer Workers", menu=self.workers_menu)
+        for workers in [1, 2, 4, 8, 16]:
+            self.workers_menu.add_radiobutton(label=str(workers), value=workers, variable=self.workers_var, command=self.set_transfer_workers)
+
+        # Count reads, bases, N50 and mean Q while transferring
+        self.read_stats_var = tk.BooleanVar(value=self.config_data["transfer_read_stats"])
+        self.theme_menu.add_checkbutton(label="Read Stats During Transfer", variable=self.read_stats_var, command=self.set_read_stats)
+
+        self.hardlink_var = tk.BooleanVar(value=self.config_data["transfer_hardlink_single"])
+        self.theme_menu.add_checkbutton(label="Hard Link Single-Chunk Barcodes", variable=self.hardlink_var, command=self.set_hardlink)
+        self.upload_reads_var = tk.BooleanVar(value=self.config_data["upload_reads"])
+        self.theme_menu.add_checkbutton(label="Stage Reads for Upload", variable=self.upload_reads_var, command=self.set_upload_reads)
+
+        # Keep transfers from competing with MinKNOW for the disk during a live run
+        self.io_idle_var = tk.BooleanVar(value=self.config_data["io_idle_class"])
+        self.theme_menu.add_checkbutton(label="Low Priority Transfer I/O", variable=self.io_idle_var, command=self.set_io_options)
+        self.io_backoff_var = tk.BooleanVar(value=self.config_data["io_backoff"])
+        self.theme_menu.add_checkbutton(label="Slow Transfers When MinKNOW Is Busy", variable=self.io_backoff_var, command=self.set_io_options)
+        self.io_max_var = tk.IntVar(value=self.config_data["io_max_mbps"])
+        self.io_max_menu = Menu(self.theme_menu, tearoff=0)
+        self.theme_menu.add_cascade(label="Transfer Speed Cap", menu=self.io_max_menu)
+        for mbps in [0, 20, 50, 100, 200]:
+            self.io_max_menu.add_radiobutton(label=f"{mbps} MB/s" if mbps else "Unlimited", value=mbps, variable=self.io_max_var, command=self.set_io_options)
+        # Cores and memory given to Snakemake, see run_profile
+        self.run_profile_var = tk.StringVar(value=self.config_data["run_profile"])
+        self.run_profile_menu = Menu(self.theme_menu, tearoff=0)
+        self.theme_menu.add_cascade(label="MARPLE Run Resources", menu=self.run_profile_menu)
+        self.run_profile_menu.add_radiobutton(label="Fit to Free Cores and Memory", value="auto", variable=self.run_profile_var, command=self.set_run_profile)
+        self.run_profile_menu.add_radiobutton(label="Use All Cores (No Limits)", value="all", variable=self.run_profile_var, command=self.set_run_profile)
+        self.minknow_headroom_var = tk.BooleanVar(value=self.config_data["run_minknow_headroom"])
+        self.theme_menu.add_checkbutton(label="Leave Headroom for MinKNOW During Runs", variable=self.minknow_headroom_var, command=self.set_run_profile)
+
+        # Run mode (Home Page): samples transferred since the last successful run,
+        # the samples or pathogens typed in, or the whole workspace
+        self.run_modes = {"New samples": "new", "Selected": "selected", "Full rebuild": "full"}
+        self.run_mode_var = tk.StringVar(value="New samples")
+        self.run_mode_button = ctk.CTkSegmentedButton(self, values=list(self.run_modes), variable=self.run_mode_var, font=self.font)
+        self.run_mode_button.pack(pady=(30, 10))
+        self.run_samples_entry = ctk.CTkEntry(self, placeholder_text="Samples or pathogens for Selected, e.g. M123, pst", width=400, font=self.font)
+        self.run_samples_entry.pack(pady=(0, 0))
+        self.snakemake_run = None
+
         # Run MARPLE button (Home Page)
         self.run_marple_button = ctk.CTkButton(self, text="RUN MARPLE", command=self.run_marple, corner_radius=1, font=self.large_font)
         self.run_marple_button.pack(pady=(30, 30))
@@ -89,9 +151,19 @@ class App(ctk.CTk):
         self.snakemake_process = None
 
         self.transfer_in_progress = False
+        self.rebuild_var = tk.BooleanVar(value=False)
+        self.follow_var = tk.BooleanVar(value=False)
+        self.filter_var = tk.BooleanVar(value=self.config_data["transfer_filter"])
+        self.transfer_filters = None
+        self.follower = None
+        self.stop_follow_button = ctk.CTkButton(self, text="Stop Following Run", command=self.stop_follow, corner_radius=1, font=self.font)
         self.dynamic_frame = None
 
         self.progress_bar = ctk.CTkProgressBar(self, orientation="horizontal")
+        self.transfer_status_label = ctk.CTkLabel(self, text="", font=self.font)
+        self.transfer_progress = None
+        self.transfer_throttle = None
+        self.transfer_rows = {}
         
         self.notification_frame = ctk.CTkFrame(self, bg_color=self.colswitch)
 
@@ -106,12 +178,41 @@ class App(ctk.CTk):
         # Update the theme toggle text in the menu
         self.theme_menu.entryconfig(0, label=f'{"Dark mode" if self.colmode == "light" else "Light mode"}')
 
+    def set_transfer_workers(self):
+        self.config_data["transfer_workers"] = self.workers_var.get()
+        save_config(self.marpledir, self.config_data)
+
+    def set_read_stats(self):
+        self.config_data["transfer_read_stats"] = self.read_stats_var.get()
+        save_config(self.marpledir, self.config_data)
+
+    def set_hardlink(self):
+        self.config_data["transfer_hardlink_single"] = self.hardlink_var.get()
+        save_config(self.marpledir, self.config_data)
+
+    def set_upload_reads(self):
+        self.config_data["upload_reads"] = self.upload_reads_var.get()
+        save_config(self.marpledir, self.config_data)
+
+    def set_io_options(self):
+        self.config_data["io_idle_class"] = self.io_idle_var.get()
+        self.config_data["io_backoff"] = self.io_backoff_var.get()
+        self.config_data["io_max_mbps"] = self.io_max_var.get()
+        save_config(self.marpledir, self.config_data)
+
+    def set_run_profile(self):
+        self.config_data["run_profile"] = self.run_profile_var.get()
+        self.config_data["run_minknow_headroom"] = self.minknow_headroom_var.get()
+        save_config(self.marpledir, self.config_data)
+
     def update_ui(self):
         if self.dynamic_frame:
             self.dynamic_frame.configure(bg_color=self.colswitch)
 
     def show_home(self):
         self.clear_dynamic_frame()
+        self.run_mode_button.pack(pady=(30, 10))
+        self.run_samples_entry.pack(pady=(0, 0))
         self.run_marple_button.pack(pady=(30, 30))
         self.stop_button.pack(pady=(10, 20))
         # self.output_text.pack(pady=(20, 20))
@@ -129,10 +230,40 @@ class App(ctk.CTk):
         self.expname_label.pack(pady=(10, 20))
 
         self.add_row_button = ctk.CTkButton(self.dynamic_frame, text="Add Barcode Row", command=self.add_barcode_row, corner_radius=1, font=self.font)
-        self.add_row_button.pack(pady=(10, 20))
+        self.add_row_button.pack(pady=(10, 5))
+
+        # Fill many rows from one view of a rack or label sheet
+        self.batch_scan_button = ctk.CTkButton(self.dynamic_frame, text="Batch Scan MARPLE Barcodes", command=self.toggle_batch_scan, corner_radius=1, font=self.font)
+        self.batch_scan_button.pack(pady=(5, 5))
+
+        self.import_photos_button = ctk.CTkButton(self.dynamic_frame, text="Import from Photos", command=self.import_photos, corner_radius=1, font=self.font)
+        self.import_photos_button.pack(pady=(5, 20))
 
         self.transfer_reads_button = ctk.CTkButton(self.dynamic_frame, command=self.transfer_reads, text="Transfer Reads", corner_radius=1, font=self.large_font)
-        self.transfer_reads_button.pack(pady=(10, 20))
+        self.transfer_reads_button.pack(pady=(10, 5))
+        if self.follower and self.follower.stop_event.is_set():
+            self.transfer_reads_button.configure(state="disabled")
+
+        # Samples are normally topped up with new chunks only; this forces a full copy
+        self.rebuild_checkbox = ctk.CTkCheckBox(self.dynamic_frame, text="Rebuild existing samples", variable=self.rebuild_var, corner_radius=1, font=self.font)
+        self.rebuild_checkbox.pack(pady=(5, 5))
+
+        # Keep appending new chunks to the samples while MinKNOW is still sequencing
+        self.follow_checkbox = ctk.CTkCheckBox(self.dynamic_frame, text="Follow run (transfer new chunks as they arrive)", variable=self.follow_var, corner_radius=1, font=self.font)
+        self.follow_checkbox.pack(pady=(5, 5))
+
+        # Optional read filtering and base cap applied while transferring
+        self.filter_frame = ctk.CTkFrame(self.dynamic_frame, bg_color=self.colswitch, corner_radius=1)
+        self.filter_frame.pack(pady=(5, 20))
+        self.filter_checkbox = ctk.CTkCheckBox(self.filter_frame, text="Filter reads", variable=self.filter_var, corner_radius=1, font=self.font)
+        self.filter_checkbox.pack(side="left", padx=5)
+        self.filter_entries = {}
+        for key, label in [("filter_min_length", "Min length"), ("filter_min_q", "Min Q"), ("filter_max_mb", "Max Mb/sample")]:
+            ctk.CTkLabel(self.filter_frame, text=label, font=self.font).pack(side="left", padx=(10, 2))
+            entry = ctk.CTkEntry(self.filter_frame, width=70, corner_radius=1, font=self.font)
+            entry.insert(0, str(self.config_data[key]))
+            entry.pack(side="left", padx=2)
+            self.filter_entries[key] = entry
 
         # Frame to contain canvas and scrollbar
         self.canvas_frame = ctk.CTkFrame(self.dynamic_frame, bg_color=self.colswitch)
@@ -181,6 +312,10 @@ class App(ctk.CTk):
         remove_button = ctk.CTkButton(row_container, text="Remove", command=lambda: self.remove_barcode_row(row_container), corner_radius=1, font=self.font)
         remove_button.pack(side="left", padx=5)
 
+        # Per-row transfer progress
+        status_label = ctk.CTkLabel(row_container, text="", font=self.font)
+        status_label.pack(side="left", padx=5)
+
         # Metadata container for the dropdown selection
         metadata_container = ctk.CTkFrame(self.scrollable_frame, bg_color=self.colswitch, corner_radius=1)
         metadata_container.pack(fill="x", anchor="center", padx=5)
@@ -192,7 +327,8 @@ class App(ctk.CTk):
             "transfer_type": segmented_button,
             "dropdown_var": dropdown_var,
             "dropdown_menu": dropdown_menu,
-            "metadata_container": metadata_container
+            "metadata_container": metadata_container,
+            "status_label": status_label
         })
 
         # Show default option's fields by default
@@ -225,137 +361,195 @@ class App(ctk.CTk):
         elif choice == "No Barcode":
             self.show_no_barcode_option(metadata_container, row)
             
-    def scan_barcode_cam(self, marple_barcode=False):
-        cam_index = self.find_external_camera()
-        if cam_index is None:
-            messagebox.showerror("Error", "No camera found!")
+    def toggle_scanner(self, container, row, marple_toggle=False):
+        # A second click while the camera is open stops the scan
+        if self.scanner and self.scanner.is_running():
+            self.scanner.stop()
             return
-        
-        cap = cv2.VideoCapture(cam_index)
-        if not cap.isOpened():
-            messagebox.showerror("Error", "Could not open any camera.")
-            return None
-        
-        barcode_data = None
-        self.scanner_running = True
-
-        # Add timeout to limit cpu/gpu usage
-        start_time = time.time()
-
-        while self.scanner_running:
-            elapsed_time = time.time() - start_time
-            if elapsed_time > 20:  # 20-second timeout
-                messagebox.showwarning("Warning","Camera timeout. No barcode detected within 20 seconds.")
-                break
-
-            ret, frame = cap.read()
-            if not ret:
-                self.printin("Error: Failed to capture image.")
-                break
-
-            # Trying to increase the chances of successful scan by enhancing image
-            # Convert frame to grayscale
-            gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-            # Apply a sharpening filter
-            kernel = np.array([[0, -1, 0], 
-                            [-1, 5, -1], 
-                            [0, -1, 0]])
-            
-            # Combine sharpening with contrast enhancement using CLAHE (Contrast Limited Adaptive Histogram Equalization))
-            
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-            equalized = clahe.apply(gray_frame)
-
-            # Sharpen after histogram equalization
-            sharp_frame = cv2.filter2D(equalized, -1, kernel)
-
-            # Adjust brightness and contrast (clip values to stay in valid range)
-            alpha = 2    # Contrast control (1.0-3.0)
-            beta = 20    # Brightness control (0-100)
-            enhanced_frame = cv2.convertScaleAbs(sharp_frame, alpha=alpha, beta=beta)
-
-            # Upscale image for better decoding
-            upscale_factor = 2
-            enhanced_frame = cv2.resize(enhanced_frame, 
-                                        (frame.shape[1] * upscale_factor, frame.shape[0] * upscale_factor), 
-                                        interpolation=cv2.INTER_LINEAR)
-
-            barcodes = pyzbar.decode(enhanced_frame)
-
-            for barcode in barcodes:
-                barcode_data = barcode.data.decode("utf-8")
-                if marple_barcode and barcode_data.startswith("M"):
-                    self.scanner_running = False
-                    messagebox.showinfo("Info",f"MARPLE Barcode detected: {barcode_data}")
-                    break
-                elif marple_barcode and not barcode_data.startswith("M"):
-                    # I used to be able to just continue scanning until a valid barcode was detected
-                    # but now it seems to be stuck in an infinite loop if an invalid barcode is scanned
-                    # so I'm breaking out of the loop and returning None
-                    self.scanner_running = False
-                    messagebox.showerror("Error","Invalid barcode. Please scan a MARPLE barcode.")
-                    break
-                else:
-                    self.printin(f"Barcode detected: {barcode_data}")
-                    self.scanner_running = False
-                    break
+        self.start_scanner(BarcodeScanner(on_result=lambda result: self.after(0, self.on_scan_result, container, row, marple_toggle, result),
+                                          camera=self.camera_registry.preferred_index))
 
+    def toggle_batch_scan(self):
+        if self.scanner and self.scanner.is_running():
+            self.scanner.stop()
+            return
+        self.start_scanner(BarcodeScanner(on_result=lambda result: self.after(0, self.on_batch_scan_result, result),
+                                          camera=self.camera_registry.preferred_index, batch=True))
+        self.printin("Batch scan: hold the rack or label sheet in view; close the camera window when done.")
+
+    def start_scanner(self, scanner):
+        self.scanner = scanner
+        self.scanner.start()
+        self.scanner_window_shown = False
+        self.after(30, self.update_scanner_preview, self.scanner)
+
+    def update_scanner_preview(self, scanner):
+        # The preview window belongs to the Tk thread; capture and decoding happen
+        # on the scanner's own threads
+        if scanner is not self.scanner or not scanner.is_running():
+            cv2.destroyAllWindows()
+            return
+        frame = scanner.latest_frame()
+        if frame is not None:
+            region = getattr(scanner.decoder, "roi", None)
+            if region:
+                x, y, w, h = region
+                frame = cv2.rectangle(frame.copy(), (x, y), (x + w, y + h), (0, 200, 0), 2)
+            if scanner.batch:
+                frame = cv2.putText(frame.copy(), f"{len(scanner.found_codes())} codes", (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 200, 0), 2)
             cv2.imshow("Scan Barcode", frame)
+            self.scanner_window_shown = True
+        key = cv2.waitKey(1) & 0xFF
+        if key == ord('q') or (self.scanner_window_shown and cv2.getWindowProperty("Scan Barcode", cv2.WND_PROP_VISIBLE) < 1):
+            scanner.stop()
+        self.after(30, self.update_scanner_preview, scanner)
+
+    def on_scan_result(self, container, row, marple_toggle, result):
+        tier = f" ({result['tier']})" if result["tier"] else ""
+        print(f"Scanner: {result['reason']}{tier}, {format_scan_stats(result['stats'])}")
+        barcode_data = result["data"]
+        if self.scan_failed(result) or result["reason"] == "stopped":
+            return
+        elif marple_toggle and barcode_data.startswith("M"):
+            messagebox.showinfo("Info", f"MARPLE Barcode detected: {barcode_data}")
+        elif marple_toggle:
+            messagebox.showerror("Error", "Invalid barcode. Please scan a MARPLE barcode.")
+        else:
+            self.printin(f"Barcode detected: {barcode_data}")
 
-            if (cv2.waitKey(1) & 0xFF == ord('q')) or (cv2.getWindowProperty("Scan Barcode", cv2.WND_PROP_VISIBLE) < 1):
-                self.scanner_running = False
-                break
-
-        cap.release()
-        cv2.destroyAllWindows()
-        return barcode_data
+        if barcode_data is None:
+            return
+        if marple_toggle:
+            self.update_marple_entry(container, row, barcode_data)
+        else:
+            self.update_odk_entry(container, row, barcode_data)
+
+    def scan_failed(self, result):
+        # Shows what went wrong, if anything, and returns True in that case
+        if result["reason"] in ("no camera", "open failed", "capture failed"):
+            # The cached camera list may be out of date
+            self.camera_registry.invalidate()
+        if result["reason"] == "timeout":
+            messagebox.showwarning("Warning", f"Camera timeout. No barcode detected within {SCAN_TIMEOUT} seconds.")
+        elif result["reason"] == "no camera":
+            messagebox.showerror("Error", "No camera found!")
+        elif result["reason"] == "open failed":
+            messagebox.showerror("Error", "Could not open any camera.")
+        elif result["reason"] == "capture failed":
+            self.printin("Error: Failed to capture image.")
+        elif result["reason"] == "error":
+            messagebox.showerror("Error", f"Scanner error: {result['error']}")
+        else:
+            return False
+        return True
 
-    def find_external_camera(self):
-        max_inputs = 8
-        camera_indices = []
-        
-        for i in range(max_inputs):
-            cap = cv2.VideoCapture(i)
-            if cap.isOpened():
-                # Test if camera works
-                ret, _ = cap.read()
-                if ret:
-                    camera_indices.append(i)
-                cap.release()
-        
-        # Identify external webcam (assume external by resolution)
-        for index in camera_indices:
-            cap = cv2.VideoCapture(index)
-            if cap.isOpened():
-                # Retrieve resolution
-                width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                print(f"Camera {index}: {width}x{height}")
-                cap.release()
-                if width > 1280 or height > 720:
-                    return index
-        
-        if camera_indices[0] == 0:
-            self.printin(f"External webcam not found. Falling back to the default camera ({height}p).")
+    def on_batch_scan_result(self, result):
+        tier = f" ({result['tier']})" if result["tier"] else ""
+        print(f"Batch scan: {result['reason']}{tier}, {len(result['codes'])} codes, {format_scan_stats(result['stats'])}")
+        if not result["codes"] and self.scan_failed(result):
+            return
+        marple_codes = [code for code in result["codes"] if code.startswith("M")]
+        assigned = self.assign_batch_codes(marple_codes)
+        skipped = len(result["codes"]) - len(marple_codes)
+        message = f"Batch scan: {assigned} MARPLE barcodes added to rows"
+        if len(marple_codes) > assigned:
+            message += f", {len(marple_codes) - assigned} already assigned"
+        if skipped:
+            message += f", {skipped} other codes ignored"
+        self.printin(message + ".")
+
+    def assign_batch_codes(self, codes):
+        # Fill rows that expect a scanned MARPLE barcode but have none yet, in row
+        # order, adding rows when there are more codes than rows. Codes already on
+        # a row (from an earlier scan) are skipped.
+        existing = {row.get("marple_barcode") for row in self.barcode_rows}
+        codes = [code for code in dict.fromkeys(codes) if code not in existing]
+        for code in codes:
+            row = self.next_unscanned_row()
+            self.update_marple_entry(row["metadata_container"], row["row_container"], code)
+            row["status_label"].configure(text=code)
+        return len(codes)
+
+    def next_unscanned_row(self):
+        # First row that expects a scanned MARPLE barcode but has none, or a new row
+        row = next((row for row in self.barcode_rows
+                    if not row.get("marple_barcode") and row["dropdown_var"].get() != "No Barcode"), None)
+        if row is None:
+            self.add_barcode_row()
+            row = self.barcode_rows[-1]
+        return row
+
+    def import_photos(self):
+        folder = filedialog.askdirectory(title="Select a folder of label photos")
+        if not folder:
+            return
+        paths = photo_files(folder)
+        if not paths:
+            messagebox.showerror("Error", "No photos found in the selected folder.")
+            return
+        self.printin(f"Decoding {len(paths)} photos...")
+        threading.Thread(target=self.decode_photo_folder, args=(paths,), daemon=True).start()
 
-        # Default to the first available camera if no external is found
-        return camera_indices[0] if camera_indices else None
+    def decode_photo_folder(self, paths):
+        try:
+            results = decode_photos(paths)
+        except Exception as e:
+            self.after(0, messagebox.showerror, "Error", f"Photo import failed: {e}")
+            return
+        self.after(0, self.apply_photo_results, results)
 
-    def toggle_scanner(self, container, row, marple_toggle=False):
-        self.run_scanner(container, row, marple_toggle)
+    def row_barcode(self, row):
+        try:
+            return format_barcode(row["barcode"].get())
+        except ValueError:
+            return None
 
-    def run_scanner(self, container, row, marple_toggle=False):
-        with self.lock:
-            self.scanner_running = True
-        if marple_toggle:
-            marple_barcode_data = self.scan_barcode_cam(marple_barcode=True)
-            self.after(0, self.update_marple_entry, container, row, marple_barcode_data)
-        else:
-            odk_barcode_data = self.scan_barcode_cam(marple_barcode=False)
-            self.after(0, self.update_odk_entry, container, row, odk_barcode_data)
-        with self.lock:
-            self.scanner_running = False
+    def apply_photo_results(self, results):
+        # Photos named after a MinKNOW barcode (barcode05.jpg, 05.jpg) go to the row
+        # with that barcode, which is added if missing. The others fill rows still
+        # waiting for a MARPLE barcode, in file name order.
+        existing = {row.get("marple_barcode") for row in self.barcode_rows}
+        unmatched = []
+        without_code = []
+        assigned = 0
+        for result in results:
+            marple, other = photo_codes(result)
+            if marple is None:
+                without_code.append(os.path.basename(result["path"]))
+                continue
+            if marple in existing:
+                continue
+            existing.add(marple)
+            barcode = photo_barcode(result["path"])
+            if barcode is None:
+                unmatched.append((marple, other))
+                continue
+            row = next((row for row in self.barcode_rows if self.row_barcode(row) == barcode), None)
+            if row is None:
+                self.add_barcode_row()
+                row = self.barcode_rows[-1]
+                row["barcode"].insert(0, barcode)
+            self.set_photo_codes(row, marple, other)
+            assigned += 1
+        for marple, other in unmatched:
+            self.set_photo_codes(self.next_unscanned_row(), marple, other)
+            assigned += 1
+
+        message = f"Imported {assigned} MARPLE barcodes from {len(results)} photos."
+        if without_code:
+            shown = ", ".join(without_code[:5]) + (", ..." if len(without_code) > 5 else "")
+            message += f" No MARPLE barcode in {len(without_code)}: {shown}"
+        self.printin(message)
+
+    def set_photo_codes(self, row, marple, other):
+        # A second code on the label is the ODK code of a sample extracted from live
+        if other and row["dropdown_var"].get() == "Recorded In-Field":
+            row["dropdown_var"].set("Extracted from Live")
+            self.on_dropdown_select("Extracted from Live", row["row_container"])
+        self.update_marple_entry(row["metadata_container"], row["row_container"], marple)
+        if other:
+            self.update_odk_entry(row["metadata_container"], row["row_container"], other)
+        row["status_label"].configure(text=f"{marple} / {other}" if other else marple)
 
     def update_marple_entry(self, container, row, marple_barcode_data):
         with self.lock:
@@ -478,6 +672,21 @@ class App(ctk.CTk):
         if self.minknow_dir and (self.minknow_dir != self.minknow_default_dir):
             expname = os.path.basename(self.minknow_dir)
             self.expname_label.configure(text=f"Experiment Name: {expname}")
+            # Index the experiment in the background so the transfer can reuse it
+            threading.Thread(target=self.index_experiment, args=(self.minknow_dir,), daemon=True).start()
+
+    def index_experiment(self, minknow_dir):
+        try:
+            index = get_experiment_index(minknow_dir)
+        except Exception as e:
+            self.after(0, self.printin, f"Failed to index {minknow_dir}: {e}")
+            return
+        self.after(0, self.update_expname_label, index)
+
+    def update_expname_label(self, index):
+        # Only update if the selection has not changed in the meantime
+        if index["experiment_dir"] == self.minknow_dir:
+            self.expname_label.configure(text=f"Experiment Name: {index['experiment']} ({describe_index(index)})")
 
     def transfer_reads(self):
         if not self.minknow_dir or self.minknow_dir == self.minknow_default_dir:
@@ -510,36 +719,59 @@ class App(ctk.CTk):
             messagebox.showwarning("Warning","Transfer Reads Process Running. Wait until it finishes.")
             return
 
+        # Kept until the follow thread has exited, as it may still be appending
+        if self.follower:
+            messagebox.showwarning("Warning","Still following a run. Stop following before transferring again.")
+            return
+
+        try:
+            self.transfer_filters = self.read_filter_settings()
+        except ValueError:
+            messagebox.showerror("Error","Read filter values must be numbers (0 to disable).")
+            return
+
         # Start the transfer process
         self.transfer_in_progress = True
-        self.progress_bar.pack(pady=(10, 20))
-        self.progress_bar.configure(mode="indeterminate")
-        self.progress_bar.start()
+        self.transfer_progress = TransferProgress()
+        self.transfer_throttle = make_throttle(self.config_data)
+        self.transfer_rows = {}
+        self.progress_bar.pack(pady=(10, 5))
+        self.progress_bar.configure(mode="determinate")
+        self.progress_bar.set(0)
+        self.transfer_status_label.configure(text="Indexing experiment...")
+        self.transfer_status_label.pack(pady=(0, 20))
+        for row in self.barcode_rows:
+            row["status_label"].configure(text="")
+        self.after(250, self.update_transfer_progress)
 
         # Run the task in a separate thread to avoid freezing the UI
         self.transfer_thread = threading.Thread(target=self.process_reads)
         self.transfer_thread.start()
             
+    def read_filter_settings(self):
+        self.config_data["transfer_filter"] = self.filter_var.get()
+        self.config_data["filter_min_length"] = int(self.filter_entries["filter_min_length"].get().strip() or 0)
+        self.config_data["filter_min_q"] = float(self.filter_entries["filter_min_q"].get().strip() or 0)
+        self.config_data["filter_max_mb"] = float(self.filter_entries["filter_max_mb"].get().strip() or 0)
+        save_config(self.marpledir, self.config_data)
+        if not self.config_data["transfer_filter"]:
+            return None
+        return {
+            "min_length": self.config_data["filter_min_length"],
+            "min_q": self.config_data["filter_min_q"],
+            "max_bases": int(self.config_data["filter_max_mb"] * 1e6)
+        }
+
     def process_reads(self):
+        results = None
         try:
             total_barcodes = len(self.barcode_rows)
             if total_barcodes == 0:
                 messagebox.showerror("Error","No barcodes to process.")
                 return
 
-            # Read existing metadata
-            metadata_file = os.path.join(self.marpledir, 'sample_metadata.csv')
-            if not os.path.exists(metadata_file):
-                with open(metadata_file, 'w') as f:
-                    f.write('Experiment,Barcode,SampleName,Pathogen,CollectionDate,CollectorsName,Location,Country,Cultivar,Treatment,ODKcode\n')
-
-            existing_metadata = []
-            if os.path.exists(metadata_file):
-                with open(metadata_file, 'r') as f:
-                    existing_metadata = f.readlines()
-
+            samples = []
             for row in self.barcode_rows:
-                experiment = os.path.basename(self.minknow_dir)
                 barcode_entry = row["barcode"]
                 sample_entry = row.get("sample") or row.get("marple_barcode")
                 segmented_button = row["transfer_type"]
@@ -551,7 +783,7 @@ class App(ctk.CTk):
                 meta_treat = row.get("treat")
                 meta_odk = row.get("odk_barcode")
 
-                barcode = format(int(barcode_entry.get().strip()), '02d')
+                barcode = format_barcode(barcode_entry.get())
                 if hasattr(sample_entry, "strip"):
                     sample = sample_entry.strip() if sample_entry else ""
                 else:
@@ -561,40 +793,146 @@ class App(ctk.CTk):
                 if not barcode:
                     continue
 
-                # Check if the sample and pathogen already exist in the metadata
-                new_metadata_line = f"{experiment},{barcode},{sample},{pathogen},{meta_date.get().strip() if meta_date else ''},{meta_name.get().strip() if meta_name else ''},{meta_loc.get().strip() if meta_loc else ''},{meta_country.get().strip() if meta_country else ''},{meta_cultivar.get().strip() if meta_cultivar else ''},{meta_treat.get().strip() if meta_treat else ''},{meta_odk.strip() if meta_odk else ''}\n"
-                existing_metadata = [line for line in existing_metadata if not (sample in line and pathogen in line)]
-
-                for root, dirs, files in os.walk(self.minknow_dir):
-                    for dir in dirs:
-                        if dir == 'pass':
-                            barcode_dir = os.path.join(root, dir, f'barcode{barcode}')
-                            if os.path.exists(barcode_dir):
-                                try:
-                                    output_file = os.path.join(self.marpledir, 'reads', pathogen.lower(), f'{sample}.fastq.gz')
-                                    command = f"cat {barcode_dir}/*.fastq.gz > {output_file}"
-                                    subprocess.run(command, shell=True)
-                                    self.printin(f"Successfully transferred reads for barcode{barcode} to {output_file}")
-
-                                    existing_metadata.append(new_metadata_line)
-
-                                except Exception as e:
-                                    messagebox.showerror("Error",f"An error occurred while processing barcode{barcode}: {e}")
-                            else:
-                                messagebox.showerror("Error",f"Barcode{barcode} not found in MinKNOW directory.")
-
-            # Write the updated metadata back to the file
-            with open(metadata_file, 'w') as f:
-                f.writelines(existing_metadata)
-
-            backup_dir = '/marple/upload'
-            if not os.path.exists(backup_dir):
-                os.makedirs(backup_dir)
-            shutil.copy(metadata_file, os.path.join(backup_dir, 'sample_metadata.csv'))
+                samples.append({
+                    "barcode": barcode,
+                    "sample": sample,
+                    "pathogen": pathogen,
+                    "collection_date": meta_date.get().strip() if meta_date else '',
+                    "collector_name": meta_name.get().strip() if meta_name else '',
+                    "location": meta_loc.get().strip() if meta_loc else '',
+                    "country": meta_country.get().strip() if meta_country else '',
+                    "cultivar": meta_cultivar.get().strip() if meta_cultivar else '',
+                    "treat": meta_treat.get().strip() if meta_treat else '',
+                    "odk_barcode": meta_odk.strip() if meta_odk else ''
+                })
+                # The first row for a sample is the one transferred; later duplicates are rejected
+                self.transfer_rows.setdefault(sample_output_file(self.marpledir, pathogen, sample), row)
+
+            engine = TransferEngine(workers=self.config_data["transfer_workers"], read_stats=self.config_data["transfer_read_stats"],
+                                    filters=self.transfer_filters, throttle=self.transfer_throttle,
+                                    hardlink=self.config_data["transfer_hardlink_single"])
+            try:
+                results, follow_jobs = transfer_samples(self.marpledir, self.minknow_dir, samples, engine, progress=self.transfer_progress,
+                                                        rebuild=self.rebuild_var.get(), follow=self.follow_var.get())
+            finally:
+                engine.close()
+            self.metadata_compactor.request()
+
+            if follow_jobs:
+                self.after(0, self.start_follow, follow_jobs)
 
         finally:
             self.transfer_in_progress = False
-            self.stop_progress_bar()
+            self.after(0, self.finish_transfer_progress)
+            if results is not None:
+                self.after(0, self.report_transfer_results, results)
+
+    def update_transfer_progress(self):
+        # Polled from the Tk loop, so the rate of GUI updates does not depend on
+        # how fast the workers copy
+        if not self.transfer_in_progress:
+            return
+        self.refresh_transfer_progress()
+        self.after(250, self.update_transfer_progress)
+
+    def finish_transfer_progress(self):
+        # Leave the final per-row figures in place
+        self.refresh_transfer_progress()
+        self.stop_progress_bar()
+
+    def refresh_transfer_progress(self):
+        snapshot = self.transfer_progress.snapshot()
+        if snapshot["items"]:
+            self.progress_bar.set(snapshot["overall"]["fraction"])
+            self.transfer_status_label.configure(text=f"{format_progress(snapshot['overall'])}  |  I/O: {self.transfer_throttle.state}")
+        for key, stats in snapshot["items"].items():
+            row = self.transfer_rows.get(key)
+            if row and row["status_label"].winfo_exists():
+                row["status_label"].configure(text=f"{stats['fraction'] * 100:.0f}%  {format_progress(stats)}")
+
+    def start_follow(self, jobs):
+        follower = FollowTransfer(self.minknow_dir, jobs, workers=self.config_data["transfer_workers"], on_result=self.on_follow_result,
+                                  filters=self.transfer_filters, throttle=make_throttle(self.config_data),
+                                  hardlink=self.config_data["transfer_hardlink_single"])
+        # Called from the follow thread just before it exits
+        follower.on_error = lambda message: self.after(0, self.follower_failed, follower, message)
+        self.follower = follower
+        self.follower.start()
+        self.stop_follow_button.pack(pady=(10, 20))
+        self.printin(f"Following {len(jobs)} barcodes in {os.path.basename(self.minknow_dir)}.")
+
+    def on_follow_result(self, result):
+        # Called from the follow thread
+        job = result["job"]
+        if result["ok"]:
+            message = f"barcode{job['barcode']}: added {result['detail']['chunks_added']} chunks to {os.path.basename(job['output_file'])}"
+        else:
+            message = f"barcode{job['barcode']}: {result['error']}"
+        self.after(0, self.printin, message)
+
+    def follower_failed(self, follower, message):
+        self.printin(message)
+        if self.follower is not follower:
+            # Already stopped from the GUI
+            return
+        self.follower = None
+        self.stop_follow_button.pack_forget()
+        if self.transfer_reads_button_exists():
+            self.transfer_reads_button.configure(state="normal")
+        messagebox.showerror("Follow mode", message)
+
+    def stop_follow(self):
+        self.stop_follow_button.pack_forget()
+        if not self.follower:
+            return
+        # The follow thread finishes the chunks it is appending first, so keep
+        # transfers off the same samples until it has exited
+        self.follower.stop(wait=False)
+        if self.transfer_reads_button_exists():
+            self.transfer_reads_button.configure(state="disabled")
+        self.printin("Stopping follow mode...")
+        threading.Thread(target=self.wait_for_follower, args=(self.follower,), daemon=True).start()
+
+    def wait_for_follower(self, follower):
+        follower.stop()
+        self.after(0, self.follower_stopped, follower)
+
+    def follower_stopped(self, follower):
+        if self.follower is follower:
+            self.follower = None
+        if self.transfer_reads_button_exists():
+            self.transfer_reads_button.configure(state="normal")
+        self.printin("Stopped following run.")
+        # The followed samples grew since the last staging
+        self.metadata_compactor.request()
+
+    def transfer_reads_button_exists(self):
+        return hasattr(self, "transfer_reads_button") and self.transfer_reads_button.winfo_exists()
+
+    def stage_uploads(self):
+        # Runs on the metadata compactor thread after each snapshot; only files
+        # that changed since the last staging are copied
+        report = stage_workspace(self.marpledir, include_reads=self.config_data["upload_reads"])
+        if report["staged"] or report["removed"]:
+            print(format_stage_report(report))
+
+    def report_transfer_results(self, results):
+        # Put the read statistics on each row so weak barcodes stand out before running MARPLE
+        for result in results:
+            stats = result["detail"].get("stats") if result["ok"] else None
+            row = self.transfer_rows.get(result["job"]["output_file"])
+            if stats and row and row["status_label"].winfo_exists():
+                low = stats["reads"] < self.config_data["low_read_warning"]
+                text = format_stats(stats)
+                if result["detail"].get("filter"):
+                    text += f" ({format_filter_summary(result['detail']['filter'])})"
+                row["status_label"].configure(text=text, text_color="red" if low else ("black", "white"))
+
+        summary, failed = summarise_results(results)
+        if failed:
+            messagebox.showerror("Error", summary)
+        else:
+            self.printin(summary)
     
     def show_about(self):
         self.clear_dynamic_frame()
@@ -613,16 +951,27 @@ class App(ctk.CTk):
     def stop_progress_bar(self):
         self.progress_bar.stop()
         self.progress_bar.pack_forget()
+        self.transfer_status_label.pack_forget()
         
     def clear_dynamic_frame(self):
         if self.dynamic_frame:
             self.dynamic_frame.destroy()
         
+        self.run_mode_button.pack_forget()
+        self.run_samples_entry.pack_forget()
         self.run_marple_button.pack_forget()
         self.stop_button.pack_forget()
         self.output_text.pack_forget()
+        self.run_status_label.pack_forget()
+        self.job_table.pack_forget()
             
     def run_marple(self):
+        mode = self.run_modes[self.run_mode_var.get()]
+        names = self.run_samples_entry.get().replace(",", " ").split()
+        if mode == "selected" and not names:
+            messagebox.showerror("Error","Enter the samples or pathogens to run.")
+            return
+
         # Start progress bar
         self.progress_bar.pack(pady=(10, 20))
         self.progress_bar.configure(mode="indeterminate")
@@ -635,19 +984,27 @@ class App(ctk.CTk):
             self.output_text.configure(state="disabled")
 
         # Run the Snakemake process in a separate thread
-        thread = threading.Thread(target=self.run_snakemake)
+        thread = threading.Thread(target=self.run_snakemake, args=(mode, names))
         thread.start()
         # thread.join()
         
         self.output_text.pack(pady=(20, 20))
 
-    def run_snakemake(self):
+    def run_snakemake(self, mode="full", names=()):
+        started = False
         if shutil.which("mamba") is not None:
             try:
                 env_list = subprocess.check_output(["mamba", "env", "list"], text=True)
                 if "marple-env" in env_list:
                     self.stop_marple(forced=False)
-                    self.start_marple()
+                    # The workflow reads sample_metadata.csv, so make sure the
+                    # snapshot includes the latest transfers
+                    compact_metadata(self.marpledir)
+                    run = plan_run(self.marpledir, self.config_data, mode, names)
+                    if run["targets"] == []:
+                        self.after(0, self.printin, "No new samples to run." if mode == "new" else "No samples match the selection.")
+                    else:
+                        started = self.start_marple(run)
                 else:
                     messagebox.showerror("Error","mamba environment marple-env not found.")
             except subprocess.CalledProcessError as e:
@@ -655,34 +1012,104 @@ class App(ctk.CTk):
         else:
             messagebox.showerror("Error","mamba not found.")
         
-        self.progress_bar.stop()
-        self.progress_bar.pack_forget()
+        # Once the workflow runs, drain_output takes the bar over
+        if not started:
+            self.after(0, self.stop_progress_bar)
 
-    def start_marple(self):
+    def start_marple(self, run=None):
+        run = run or {"mode": "full", "samples": [], "targets": None}
         try:
-            # Start the Snakemake process with unbuffered output
+            # Start the Snakemake process with unbuffered output. Targeted runs
+            # only build the DAG for the outputs of the samples in the run.
+            # Resources are sized from what is free at the start of the run.
+            profile = run_profile(self.config_data)
+            command = snakemake_command(run["targets"], profile)
             self.snakemake_process = subprocess.Popen(
-                ["snakemake", "--cores", "all", "--rerun-incomplete"],
+                command,
                 cwd=self.marpledir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1, universal_newlines=True
             )
             
-            # Use a thread to capture output and display it in real-time
-            threading.Thread(target=self.capture_output, args=(self.snakemake_process.stdout,), daemon=True).start()
-            threading.Thread(target=self.capture_output, args=(self.snakemake_process.stderr,), daemon=True).start()
+            # Reader threads only queue the output and write it to disk; the
+            # textbox is updated from the main loop in drain_output
+            log_file = new_log_file(self.marpledir)
+            self.snakemake_log = SnakemakeLog(log_file, progress=SnakemakeProgress(events_path(log_file)))
+            self.snakemake_log.follow(self.snakemake_process.stdout, self.snakemake_process.stderr)
+            self.snakemake_run = dict(run, command=command, profile=profile, started=time.time(), log=log_file)
+            self.after(0, self.show_output, self.snakemake_log)
             
-            self.printin("MARPLE Snakemake workflow started.")
+            if run["targets"]:
+                self.printin(f"MARPLE Snakemake workflow started for {len(run['samples'])} samples ({format_profile(profile)}).")
+            else:
+                self.printin(f"MARPLE Snakemake workflow started ({format_profile(profile)}).")
+            return True
         except Exception as e:
             messagebox.showerror("Error",f"Failed to start Snakemake: {e}")
+            return False
 
-    def capture_output(self, stream):
-        # Append captured output to the output_lines
-        for line in iter(stream.readline, ''):
-            self.output_lines.append(line)  # Store captured output
+    def show_output(self, log):
+        self.output_text.configure(state="normal")
+        self.output_text.delete("1.0", "end")
+        self.output_text.configure(state="disabled")
+        self.job_table_text = None
+        self.run_status_label.pack(pady=(0, 10))
+        self.job_table.pack(pady=(0, 10))
+        self.drain_output(log)
+        self.update_run_progress(log)
+
+    def drain_output(self, log):
+        lines, redraw = log.drain()
+        if lines:
             self.output_text.configure(state="normal")
-            self.output_text.insert("end", line)
+            if redraw:
+                self.output_text.delete("1.0", "end")
+            self.output_text.insert("end", "\n".join(lines) + "\n")
+            # Keep the textbox to the last log.max_lines lines
+            excess = int(self.output_text.index("end-1c").split(".")[0]) - 1 - log.max_lines
+            if excess > 0:
+                self.output_text.delete("1.0", f"{excess + 1}.0")
             self.output_text.see("end")
             self.output_text.configure(state="disabled")
-        stream.close()
+        if not log.finished():
+            self.after(DRAIN_INTERVAL, self.drain_output, log)
+        elif log is self.snakemake_log:
+            self.finish_run()
+            print(f"Snakemake log written to {log.log_file}")
+
+    def finish_run(self):
+        # The output pipes close as Snakemake exits
+        if self.snakemake_process.poll() is None:
+            self.after(DRAIN_INTERVAL, self.finish_run)
+            return
+        self.stop_progress_bar()
+        run = dict(self.snakemake_run, finished=time.time(), returncode=self.snakemake_process.returncode)
+        try:
+            record_run(self.marpledir, run)
+        except OSError as e:
+            print(f"Error recording MARPLE run: {e}")
+
+    def update_run_progress(self, log):
+        # On a slower timer than the log, as the table only changes by the second
+        # Checked first, so the last refresh covers everything the run printed
+        finished = log.finished()
+        self.refresh_run_progress(log.progress.snapshot())
+        if not finished:
+            self.after(TABLE_INTERVAL, self.update_run_progress, log)
+
+    def refresh_run_progress(self, snapshot):
+        if snapshot["total"]:
+            if self.progress_bar.cget("mode") != "determinate":
+                self.progress_bar.stop()
+                self.progress_bar.configure(mode="determinate")
+            self.progress_bar.set(snapshot["fraction"])
+        self.run_status_label.configure(text=format_run_progress(snapshot))
+        table = format_job_table(snapshot["jobs"])
+        if table != self.job_table_text:
+            self.job_table_text = table
+            self.job_table.configure(state="normal")
+            self.job_table.delete("1.0", "end")
+            self.job_table.insert("end", table)
+            self.job_table.see("end")
+            self.job_table.configure(state="disabled")
 
     def stop_marple(self, forced=True):
         # Stop the Snakemake process if running
@@ -797,5 +1224,6 @@ class App(ctk.CTk):
             os.system(f"xdg-open {file_path}")
         
 
-app = App()
-app.mainloop()
+if __name__ == "__main__":
+    app = App()
+    app.mainloop()
@@ -0,0 +1,72 @@
+import os
+import json
+
+# Defaults for options that can be changed from the Settings menu (or by editing
+# ~/marple/marple-gui.json directly on machines without a display)
+DEFAULTS = {
+    "transfer_workers": 4,
+    "transfer_read_stats": False,
+    # Rows with fewer reads than this are highlighted after a transfer
+    "low_read_warning": 1000,
+    # Transfer-time read filtering; 0 disables a threshold
+    "transfer_filter": False,
+    "filter_min_length": 0,
+    "filter_min_q": 0.0,
+    "filter_max_mb": 0,
+    # Sharing the disk with MinKNOW: idle I/O class for transfer workers, a fixed
+    # MB/s cap (0 for none), and backing off while the disk queue or the
+    # basecaller CPU (percent of one core) is above these thresholds
+    "io_idle_class": True,
+    "io_max_mbps": 0,
+    "io_backoff": True,
+    "io_queue_threshold": 8,
+    "io_basecaller_cpu_threshold": 300,
+    # Hard link (rather than copy) barcodes with a single chunk when MinKNOW data
+    # and ~/marple share a filesystem. Reflink clones are always tried first.
+    "transfer_hardlink_single": False,
+    # Stage reads, not just sample_metadata.csv, in the /marple/upload spool.
+    # Off by default: the spool holds a second full copy of every sample and
+    # staging is not throttled, which a field laptop may not have room for.
+    "upload_reads": False,
+    # Snakemake targets for runs on new or selected samples, relative to
+    # ~/marple; {pathogen} and {sample} are filled in. Pathogen targets are
+    # requested once per pathogen with samples in the run.
+    "run_sample_targets": [],
+    "run_pathogen_targets": ["results/{pathogen}/report/{pathogen}.multiqc.html",
+                             "results/{pathogen}/trees/{pathogen}_all.pdf"],
+    # Snakemake resources: "auto" sizes --cores and --resources mem_mb from free
+    # memory, "all" passes --cores all. run_reserve_mb is kept back for the
+    # system and the GUI, the MinKNOW reserve only while a basecaller runs, and
+    # each core needs run_mb_per_core (0 to not limit cores by memory).
+    # run_rule_threads caps rules, e.g. {"star": 8}.
+    "run_profile": "auto",
+    "run_minknow_headroom": True,
+    "minknow_reserve_cores": 4,
+    "minknow_reserve_mb": 4096,
+    "run_reserve_mb": 1024,
+    "run_min_mem_mb": 2048,
+    "run_mb_per_core": 1024,
+    "run_rule_threads": {},
+}
+
+def config_path(marpledir):
+    return os.path.join(marpledir, 'marple-gui.json')
+
+def load_config(marpledir):
+    config = dict(DEFAULTS)
+    path = config_path(marpledir)
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as f:
+                config.update(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Error reading {path}: {e}")
+    return config
+
+def save_config(marpledir, config):
+    path = config_path(marpledir)
+    try:
+        with open(path, 'w') as f:
+            json.dump(config, f, indent=2, sort_keys=True)
+    except OSError as e:
+        print(f"Error writing {path}: {e}")
@@ -0,0 +1,141 @@
+import os
+import gzip
+import json
+import math
+import numpy as np
+from collections import Counter
+from marple_files import save_json
+
+# Phred error probability for every possible quality byte (Sanger offset 33)
+ERROR_PROBS = np.array([10 ** (-max(q - 33, 0) / 10) for q in range(256)])
+
+def iter_fastq(stream):
+    # Yields (header, sequence, separator, quality) without line endings. A
+    # truncated final record is dropped.
+    while True:
+        header = stream.readline()
+        if not header:
+            return
+        seq = stream.readline()
+        plus = stream.readline()
+        qual = stream.readline()
+        if not qual:
+            return
+        yield header.rstrip(b"\r\n"), seq.rstrip(b"\r\n"), plus.rstrip(b"\r\n"), qual.rstrip(b"\r\n")
+
+def read_quality(qual):
+    # Mean read quality as nanoq reports it: average the error probabilities,
+    # then convert back to the Phred scale
+    if not qual:
+        return 0.0
+    mean_error = ERROR_PROBS[np.frombuffer(qual, dtype=np.uint8)].mean()
+    return -10 * math.log10(mean_error)
+
+def empty_stats():
+    return {"reads": 0, "bases": 0, "qual_sum": 0.0, "length_counts": Counter()}
+
+def add_read(stats, length, quality):
+    stats["reads"] += 1
+    stats["bases"] += length
+    stats["qual_sum"] += quality
+    stats["length_counts"][length] += 1
+
+def merge_stats(a, b):
+    return {
+        "reads": a["reads"] + b["reads"],
+        "bases": a["bases"] + b["bases"],
+        "qual_sum": a["qual_sum"] + b["qual_sum"],
+        "length_counts": a["length_counts"] + b["length_counts"]
+    }
+
+def chunk_read_stats(path):
+    # Runs in a worker process, one chunk at a time
+    stats = empty_stats()
+    with gzip.open(path, "rb") as f:
+        for _, seq, _, qual in iter_fastq(f):
+            add_read(stats, len(seq), read_quality(qual))
+    return stats
+
+def empty_filter_summary():
+    return {"reads_in": 0, "bases_in": 0, "reads_kept": 0, "bases_kept": 0,
+            "dropped_length": 0, "dropped_quality": 0, "capped": False}
+
+def merge_filter_summaries(a, b):
+    merged = {key: a[key] + b[key] for key in a if key != "capped"}
+    merged["capped"] = a["capped"] or b["capped"]
+    return merged
+
+def filter_chunk(path, output_file, min_length=0, min_q=0.0, max_bases=0, compresslevel=1):
+    # Runs in a worker process. Appends the reads of one chunk that pass the length
+    # and quality thresholds to output_file as a new gzip member. max_bases is what
+    # is left of the per-sample budget (0 for no cap); reading stops once it is
+    # reached. Returns what was kept and dropped, and statistics of the kept reads.
+    summary = empty_filter_summary()
+    stats = empty_stats()
+    with open(output_file, "ab") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=compresslevel, mtime=0) as out:
+        with gzip.open(path, "rb") as f:
+            for header, seq, plus, qual in iter_fastq(f):
+                length = len(seq)
+                summary["reads_in"] += 1
+                summary["bases_in"] += length
+                if length < min_length:
+                    summary["dropped_length"] += 1
+                    continue
+                quality = read_quality(qual)
+                if quality < min_q:
+                    summary["dropped_quality"] += 1
+                    continue
+                out.write(b"\n".join((header, seq, plus, qual)) + b"\n")
+                summary["reads_kept"] += 1
+                summary["bases_kept"] += length
+                add_read(stats, length, quality)
+                if max_bases and summary["bases_kept"] >= max_bases:
+                    summary["capped"] = True
+                    break
+    return summary, stats
+
+def format_filter_summary(summary):
+    dropped = summary["dropped_length"] + summary["dropped_quality"]
+    text = f"kept {summary['reads_kept']:,} reads ({summary['bases_kept'] / 1e6:.1f} Mb), dropped {dropped:,}"
+    return text + ", base cap reached" if summary["capped"] else text
+
+def n50(length_counts, total_bases):
+    running = 0
+    for length in sorted(length_counts, reverse=True):
+        running += length * length_counts[length]
+        if running * 2 >= total_bases:
+            return length
+    return 0
+
+def summarise_stats(stats):
+    return {
+        "reads": stats["reads"],
+        "bases": stats["bases"],
+        "n50": n50(stats["length_counts"], stats["bases"]),
+        "mean_q": round(stats["qual_sum"] / stats["reads"], 2) if stats["reads"] else 0.0
+    }
+
+def format_stats(summary):
+    return f"{summary['reads']:,} reads  {summary['bases'] / 1e6:.1f} Mb  N50 {summary['n50']:,}  Q{summary['mean_q']:.1f}"
+
+def stats_path(output_file):
+    return os.path.join(os.path.dirname(output_file), f".{os.path.basename(output_file)}.stats.json")
+
+def load_read_stats(output_file):
+    # Returns (chunk keys, stats) or (None, None)
+    try:
+        with open(stats_path(output_file), "r") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None, None
+    stats = {
+        "reads": saved["reads"],
+        "bases": saved["bases"],
+        "qual_sum": saved["qual_sum"],
+        "length_counts": Counter({int(length): count for length, count in saved["length_counts"].items()})
+    }
+    return [tuple(key) for key in saved["chunks"]], stats
+
+def save_read_stats(output_file, chunks, stats):
+    saved = dict(stats, chunks=[[chunk["path"], chunk["size"], chunk["mtime"]] for chunk in chunks])
+    save_json(stats_path(output_file), saved)
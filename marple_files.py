@@ -0,0 +1,22 @@
+import os
+import json
+import hashlib
+
+# File helpers shared by the transfer, read statistics and upload modules
+BUFFER_SIZE = 8 * 1024 * 1024
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BUFFER_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def save_json(path, data, indent=None):
+    # Written to a temporary file, synced and renamed, so readers only ever see
+    # the old file or the complete new one
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f, indent=indent, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f"{path}.tmp", path)
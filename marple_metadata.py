@@ -0,0 +1,204 @@
+import os
+import csv
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Column name -> key of the sample dicts built by App.process_reads and by the
+# sample sheet reader. Sample sheets use the same column names as the metadata.
+METADATA_FIELDS = {
+    "Experiment": "experiment",
+    "Barcode": "barcode",
+    "SampleName": "sample",
+    "Pathogen": "pathogen",
+    "CollectionDate": "collection_date",
+    "CollectorsName": "collector_name",
+    "Location": "location",
+    "Country": "country",
+    "Cultivar": "cultivar",
+    "Treatment": "treat",
+    "ODKcode": "odk_barcode",
+    "Reads": "reads",
+    "Bases": "bases",
+    "N50": "n50",
+    "MeanQ": "mean_q"
+}
+METADATA_COLUMNS = list(METADATA_FIELDS)
+METADATA_KEYS = list(METADATA_FIELDS.values())
+
+UPLOAD_DIR = '/marple/upload'
+
+def metadata_path(marpledir):
+    return os.path.join(marpledir, 'sample_metadata.csv')
+
+def database_path(marpledir):
+    return os.path.join(marpledir, 'sample_metadata.sqlite')
+
+def snapshot_version_path(marpledir):
+    return os.path.join(marpledir, '.sample_metadata.csv.version')
+
+@contextmanager
+def file_lock(path):
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def metadata_lock(marpledir):
+    # Serialises snapshots between the GUI and transfer commands run from a shell
+    return file_lock(os.path.join(marpledir, '.sample_metadata.lock'))
+
+def metadata_record(experiment, sample, stats=None):
+    # One metadata row as a dict keyed like METADATA_KEYS
+    values = dict(sample, experiment=experiment, **(stats or {}))
+    return {key: "" if values.get(key) is None else str(values.get(key)).strip() for key in METADATA_KEYS}
+
+class MetadataStore:
+    # Sample metadata keyed on (sample, pathogen), the same key that names the reads
+    # file, so a re-transferred sample replaces its row through an upsert. The
+    # experiment/barcode index keeps lookups flat as the history grows.
+    def __init__(self, marpledir):
+        self.marpledir = marpledir
+        self.path = database_path(marpledir)
+        new = not os.path.exists(self.path)
+        with closing(self.connect()) as conn, conn:
+            columns = ", ".join(f"{key} TEXT NOT NULL DEFAULT ''" for key in METADATA_KEYS)
+            conn.execute(f"CREATE TABLE IF NOT EXISTS samples ({columns}, UNIQUE (sample, pathogen))")
+            conn.execute("CREATE INDEX IF NOT EXISTS samples_by_run ON samples (experiment, barcode, sample, pathogen)")
+            conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        if new:
+            self.import_csv(metadata_path(marpledir))
+
+    def connect(self):
+        # One short-lived connection per operation; the GUI calls in from worker
+        # threads and the transfer command may run at the same time. Changes go to
+        # the write-ahead log, synced on every commit, so a transfer only appends
+        # the rows it changed and a crash cannot damage rows already recorded.
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def version(self, conn):
+        row = conn.execute("SELECT value FROM state WHERE key = 'version'").fetchone()
+        return row[0] if row else 0
+
+    def upsert(self, records):
+        if not records:
+            return
+        columns = ", ".join(METADATA_KEYS)
+        placeholders = ", ".join("?" for _ in METADATA_KEYS)
+        updates = ", ".join(f"{key} = excluded.{key}" for key in METADATA_KEYS if key not in ("sample", "pathogen"))
+        with closing(self.connect()) as conn, conn:
+            conn.executemany(f"INSERT INTO samples ({columns}) VALUES ({placeholders}) "
+                             f"ON CONFLICT (sample, pathogen) DO UPDATE SET {updates}",
+                             [[record.get(key, "") for key in METADATA_KEYS] for record in records])
+            # Bumped with every change so snapshots can tell whether they are stale
+            conn.execute("INSERT INTO state (key, value) VALUES ('version', 1) ON CONFLICT (key) DO UPDATE SET value = value + 1")
+
+    def import_csv(self, csv_file):
+        # Bring in sample_metadata.csv files written before the database existed.
+        # Older files lack the read statistics columns.
+        if not os.path.exists(csv_file):
+            return
+        with open(csv_file, newline='') as f:
+            rows = list(csv.reader(f))
+        header = rows[0] if rows else []
+        keys = [METADATA_FIELDS.get(column.strip()) for column in header]
+        records = []
+        for row in rows[1:]:
+            record = {key: value for key, value in zip(keys, row) if key}
+            if record.get("sample") and record.get("pathogen"):
+                records.append(record)
+        self.upsert(records)
+
+    def export_csv(self, csv_file, skip_version=None):
+        # sample_metadata.csv is still what the pipeline and the upload read, so it
+        # is regenerated from the database: written to a temporary file, synced and
+        # renamed over the old one. Returns the version written, or None if the
+        # database is still at skip_version.
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN")
+            version = self.version(conn)
+            if version == skip_version and os.path.exists(csv_file):
+                conn.rollback()
+                return None
+            # Callers hold metadata_lock, so one temporary name is enough
+            tmp_file = f"{csv_file}.tmp"
+            try:
+                with open(tmp_file, 'w', newline='') as f:
+                    writer = csv.writer(f, lineterminator='\n')
+                    writer.writerow(METADATA_COLUMNS)
+                    for row in conn.execute(f"SELECT {', '.join(METADATA_KEYS)} FROM samples ORDER BY rowid"):
+                        writer.writerow(row)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, csv_file)
+            except BaseException:
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                raise
+            conn.rollback()
+        fsync_dir(os.path.dirname(csv_file))
+        return version
+
+def fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def record_samples(marpledir, records):
+    MetadataStore(marpledir).upsert(records)
+
+def read_snapshot_version(marpledir):
+    try:
+        with open(snapshot_version_path(marpledir), 'r') as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def compact_metadata(marpledir):
+    # Bring sample_metadata.csv up to date with the database. Cheap when nothing has changed since the last snapshot.
+    with metadata_lock(marpledir):
+        version = MetadataStore(marpledir).export_csv(metadata_path(marpledir), skip_version=read_snapshot_version(marpledir))
+        if version is None:
+            return False
+        with open(snapshot_version_path(marpledir), 'w') as f:
+            f.write(str(version))
+    return True
+
+class MetadataCompactor:
+    # Writes snapshots on a background thread so transfers only pay for their
+    # database rows. Requests made while a snapshot is being written are merged.
+    # after() is then called on the same thread, e.g. to stage uploads.
+    def __init__(self, marpledir, after=None):
+        self.marpledir = marpledir
+        self.after = after
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self):
+        self.event.set()
+
+    def run(self):
+        while True:
+            self.event.wait()
+            self.event.clear()
+            try:
+                compact_metadata(self.marpledir)
+                if self.after:
+                    self.after()
+            except (OSError, sqlite3.Error) as e:
+                print(f"Error writing sample metadata snapshot: {e}")
@@ -0,0 +1,226 @@
+import os
+import re
+import sys
+import gzip
+import time
+import random
+import select
+import ctypes
+import argparse
+import threading
+import ctypes.util
+
+BARCODE_DIR = re.compile(r'^barcode(\d+)$')
+MINKNOW_DATA_DIR = "/var/lib/minknow/data"
+
+# Experiment indexes, keyed by the real path of the experiment directory
+_index_cache = {}
+_index_lock = threading.Lock()
+
+def format_barcode(value):
+    # "5", "05" and "barcode05" all mean barcode05
+    value = str(value).strip().lower()
+    if value.startswith("barcode"):
+        value = value[len("barcode"):]
+    return format(int(value), '02d')
+
+def find_experiment(experiment, minknow_root=MINKNOW_DATA_DIR, max_depth=3):
+    # Accept either a directory or an experiment name to look up under the MinKNOW
+    # data directory, like the transfer-pgt/transfer-pst shell functions do
+    if os.path.isdir(experiment):
+        return experiment
+    for root, dirs, files in os.walk(minknow_root):
+        if experiment in dirs:
+            return os.path.join(root, experiment)
+        if root[len(minknow_root):].count(os.sep) >= max_depth - 1:
+            dirs[:] = []
+    return None
+
+def scan_experiment(experiment_dir):
+    # Walk the experiment once and record every pass/barcodeNN chunk with its size
+    # and mtime. The mtime of every directory visited is kept so the index can be
+    # validated later without listing the files again.
+    dir_mtimes = {}
+    barcodes = {}
+    for root, dirs, files in os.walk(experiment_dir):
+        try:
+            dir_mtimes[root] = os.stat(root).st_mtime_ns
+        except OSError:
+            continue
+
+        match = BARCODE_DIR.match(os.path.basename(root))
+        if not match or os.path.basename(os.path.dirname(root)) != 'pass':
+            continue
+
+        chunks = barcodes.setdefault(format_barcode(match.group(1)), [])
+        for name in files:
+            if not name.endswith('.fastq.gz'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            chunks.append({"path": path, "size": st.st_size, "mtime": st.st_mtime_ns})
+
+    for chunks in barcodes.values():
+        chunks.sort(key=lambda chunk: chunk["path"])
+
+    return {
+        "experiment_dir": experiment_dir,
+        "experiment": os.path.basename(os.path.normpath(experiment_dir)),
+        "barcodes": barcodes,
+        "dir_mtimes": dir_mtimes
+    }
+
+def index_is_current(index):
+    # Adding, removing or renaming a chunk or a directory bumps the mtime of the
+    # directory containing it
+    for path, mtime in index["dir_mtimes"].items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+def get_experiment_index(experiment_dir, refresh=False):
+    key = os.path.realpath(experiment_dir)
+    with _index_lock:
+        index = _index_cache.get(key)
+    if index is not None and not refresh and index_is_current(index):
+        return index
+
+    index = scan_experiment(experiment_dir)
+    with _index_lock:
+        _index_cache[key] = index
+    return index
+
+def stat_chunks(chunks):
+    # The index is only rebuilt when a directory changes, so a chunk that is still
+    # being written keeps its old size there. Re-stat just before using it.
+    fresh = []
+    for chunk in chunks:
+        try:
+            st = os.stat(chunk["path"])
+        except FileNotFoundError:
+            continue
+        fresh.append({"path": chunk["path"], "size": st.st_size, "mtime": st.st_mtime_ns})
+    return fresh
+
+def describe_index(index):
+    total_chunks = sum(len(chunks) for chunks in index["barcodes"].values())
+    total_bytes = sum(chunk["size"] for chunks in index["barcodes"].values() for chunk in chunks)
+    return f"{len(index['barcodes'])} barcodes, {total_chunks} chunks, {total_bytes / 1e9:.2f} GB"
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+class InotifyWatcher:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = set()
+
+    def watch(self, dirs):
+        for path in dirs:
+            if path in self.watched:
+                continue
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) >= 0:
+                self.watched.add(path)
+
+    def wait(self, timeout):
+        # True if anything happened in a watched directory; the events themselves
+        # are not needed because the caller rescans
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    def watch(self, dirs):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return True
+
+    def close(self):
+        pass
+
+def make_watcher():
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable, polling instead: {e}")
+    return PollingWatcher()
+
+def settled_chunks(chunks, debounce, now=None):
+    # A chunk is taken as finished once it has not been touched for `debounce`
+    # seconds, which holds for both inotify and polling
+    now = time.time() if now is None else now
+    return [chunk for chunk in chunks if now - chunk["mtime"] / 1e9 >= debounce]
+
+def simulate_run(experiment_dir, barcodes=4, chunks=10, reads=200, interval=1.0, write_delay=0.2):
+    # Write a MinKNOW-like pass/barcodeNN tree a chunk at a time, each chunk in
+    # several writes, to exercise follow mode without a sequencer
+    pass_dir = os.path.join(experiment_dir, "simulated", "basecalling", "pass")
+    for n in range(chunks):
+        for barcode in range(1, barcodes + 1):
+            barcode_dir = os.path.join(pass_dir, f"barcode{barcode:02d}")
+            os.makedirs(barcode_dir, exist_ok=True)
+            records = []
+            for r in range(reads):
+                seq = "".join(random.choice("ACGT") for _ in range(random.randint(200, 2000)))
+                records.append(f"@read_{barcode}_{n}_{r}\n{seq}\n+\n{'5' * len(seq)}\n")
+            data = gzip.compress("".join(records).encode())
+            with open(os.path.join(barcode_dir, f"chunk_{n:05d}.fastq.gz"), "wb") as f:
+                third = len(data) // 3 + 1
+                for i in range(0, len(data), third):
+                    f.write(data[i:i + third])
+                    f.flush()
+                    time.sleep(write_delay)
+        print(f"Wrote chunk {n + 1}/{chunks} for {barcodes} barcodes")
+        time.sleep(interval)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MinKNOW experiment tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index = subparsers.add_parser("index", help="Summarise the barcodes in an experiment")
+    index.add_argument("experiment_dir")
+
+    simulate = subparsers.add_parser("simulate", help="Write a synthetic sequencing run")
+    simulate.add_argument("experiment_dir")
+    simulate.add_argument("--barcodes", type=int, default=4)
+    simulate.add_argument("--chunks", type=int, default=10)
+    simulate.add_argument("--reads", type=int, default=200)
+    simulate.add_argument("--interval", type=float, default=1.0)
+
+    args = parser.parse_args(argv)
+    if args.command == "index":
+        experiment_index = get_experiment_index(args.experiment_dir)
+        print(f"{experiment_index['experiment']}: {describe_index(experiment_index)}")
+        for barcode, chunks in sorted(experiment_index["barcodes"].items()):
+            print(f"  barcode{barcode}: {len(chunks)} chunks")
+    elif args.command == "simulate":
+        simulate_run(args.experiment_dir, barcodes=args.barcodes, chunks=args.chunks, reads=args.reads, interval=args.interval)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
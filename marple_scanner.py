@@ -0,0 +1,798 @@
+import os
+import re
+import sys
+import json
+import time
+import queue
+import argparse
+import threading
+import multiprocessing
+import cv2
+import numpy as np
+from pyzbar import pyzbar
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+SCAN_TIMEOUT = 20
+BATCH_IDLE_TIMEOUT = 5
+
+# Cameras are probed once and cached; plugging or unplugging a device changes
+# the listing of these directories and triggers a new probe
+VIDEO_SYSFS_DIR = "/sys/class/video4linux"
+MAX_CAMERAS = 8
+
+def video_devices():
+    # Device indices present on the system, or None when they cannot be listed
+    # (not Linux), in which case indices 0..MAX_CAMERAS-1 are tried
+    try:
+        names = os.listdir(VIDEO_SYSFS_DIR)
+    except OSError:
+        try:
+            names = os.listdir("/dev")
+        except OSError:
+            return None
+    return sorted(int(name[5:]) for name in names if name.startswith("video") and name[5:].isdigit())
+
+def probe_cameras(indices=None):
+    # Open each device once: check it delivers a frame and note its resolution
+    cameras = []
+    for index in range(MAX_CAMERAS) if indices is None else indices:
+        cap = cv2.VideoCapture(index)
+        try:
+            if not cap.isOpened():
+                continue
+            ret, _ = cap.read()
+            if not ret:
+                continue
+            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        finally:
+            cap.release()
+        print(f"Camera {index}: {width}x{height}")
+        cameras.append({"index": index, "width": width, "height": height, "preferred": False})
+
+    # Identify external webcam (assume external by resolution), otherwise
+    # default to the first working camera
+    external = [camera for camera in cameras if camera["width"] > 1280 or camera["height"] > 720]
+    if external:
+        external[0]["preferred"] = True
+    elif cameras:
+        cameras[0]["preferred"] = True
+        print(f"External webcam not found. Falling back to camera {cameras[0]['index']} ({cameras[0]['height']}p).")
+    return cameras
+
+class CameraRegistry:
+    def __init__(self, poll_interval=2.0):
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.cameras = []
+        self.devices = None
+        self.stale = True
+        self.thread = None
+
+    def start(self):
+        # Probe in the background straight away, then watch for hotplug
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            devices = video_devices()
+            with self.lock:
+                changed = self.stale or devices != self.devices
+            if changed:
+                self.probe(devices)
+            time.sleep(self.poll_interval)
+
+    def probe(self, devices=None):
+        cameras = probe_cameras(devices)
+        with self.lock:
+            self.cameras = cameras
+            self.devices = devices
+            self.stale = False
+        self.ready.set()
+
+    def invalidate(self):
+        # E.g. after a cached camera failed to open
+        with self.lock:
+            self.stale = True
+        self.ready.clear()
+        if self.thread is None:
+            self.probe(video_devices())
+
+    def preferred_index(self, wait=10):
+        # Normally answered from the cache; only waits if a probe is under way
+        if self.thread is None and not self.ready.is_set():
+            self.probe(video_devices())
+        self.ready.wait(wait)
+        with self.lock:
+            preferred = [camera["index"] for camera in self.cameras if camera["preferred"]]
+        return preferred[0] if preferred else None
+
+# Decode attempts from cheapest to most expensive. Every frame tries the raw
+# grayscale image; after MISSES_PER_LEVEL frames without a code the ladder adds
+# the next tier, up to the old CLAHE + sharpen + 2x upscale pipeline.
+TIERS = ["raw", "downscaled", "enhanced", "enhanced 2x"]
+TIER_SCALES = {"raw": 1, "downscaled": 0.5, "enhanced": 1, "enhanced 2x": 2}
+MISSES_PER_LEVEL = 5
+
+def stage_stats(stage_times):
+    return {stage: {"attempts": len(times), "ms": 1000 * sum(times) / len(times)} for stage, times in stage_times.items()}
+
+class DecodeLadder:
+    # clip_limit, alpha, beta and upscale tune the enhanced tiers. tiers fixes
+    # the tiers tried on every frame instead of escalating, e.g. ["enhanced 2x"]
+    # for the original pipeline.
+    def __init__(self, misses_per_level=MISSES_PER_LEVEL, clip_limit=2.0, alpha=2.0, beta=20.0, upscale=2, tiers=None):
+        self.misses_per_level = misses_per_level
+        self.alpha = alpha
+        self.beta = beta
+        self.upscale = upscale
+        self.fixed_tiers = tiers
+        self.level = 0
+        self.misses = 0
+        # Built once per scan rather than once per frame
+        self.kernel = np.array([[0, -1, 0],
+                                [-1, 5, -1],
+                                [0, -1, 0]], dtype=np.float32)
+        self.clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(8, 8))
+        self.shape = None
+        # Seconds per decode attempt, by tier
+        self.timings = {tier: [] for tier in TIERS}
+
+    def allocate(self, shape):
+        # Output buffers for every step, reused until the camera resolution changes
+        height, width = shape[:2]
+        self.shape = (height, width)
+        self.gray = np.empty((height, width), dtype=np.uint8)
+        self.small = np.empty((height // 2, width // 2), dtype=np.uint8)
+        self.equalized = np.empty((height, width), dtype=np.uint8)
+        self.sharp = np.empty((height, width), dtype=np.uint8)
+        self.enhanced = np.empty((height, width), dtype=np.uint8)
+        self.upscaled = np.empty((int(height * self.upscale), int(width * self.upscale)), dtype=np.uint8)
+
+    def to_gray(self, frame):
+        # Colour frames and grayscale images of the same size share the buffers,
+        # as RegionDecoder passes its converted frame back in
+        if frame.shape[:2] != self.shape:
+            self.allocate(frame.shape)
+        if frame.ndim == 2:
+            return frame
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
+
+    def tier_image(self, tier, gray):
+        if tier == "raw":
+            return gray
+        if tier == "downscaled":
+            return cv2.resize(gray, (self.small.shape[1], self.small.shape[0]), dst=self.small, interpolation=cv2.INTER_AREA)
+        # Contrast enhancement (CLAHE), sharpening, then brightness and contrast
+        self.clahe.apply(gray, self.equalized)
+        cv2.filter2D(self.equalized, -1, self.kernel, dst=self.sharp)
+        cv2.convertScaleAbs(self.sharp, dst=self.enhanced, alpha=self.alpha, beta=self.beta)
+        if tier == "enhanced":
+            return self.enhanced
+        return cv2.resize(self.enhanced, (self.upscaled.shape[1], self.upscaled.shape[0]), dst=self.upscaled, interpolation=cv2.INTER_LINEAR)
+
+    def decode_tier(self, gray, tier):
+        started = time.perf_counter()
+        barcodes = pyzbar.decode(self.tier_image(tier, gray))
+        self.timings[tier].append(time.perf_counter() - started)
+        scale = self.upscale if tier == "enhanced 2x" else TIER_SCALES[tier]
+        return [{"data": barcode.data.decode("utf-8"),
+                 "rect": tuple(int(value / scale) for value in barcode.rect)} for barcode in barcodes]
+
+    def decode_symbols(self, frame, known=None):
+        # Returns ([{"data", "rect"}], tier that found them) or ([], None), with
+        # rect as (x, y, width, height) in frame pixels.
+        # known is the set of codes a batch scan already has. Every tier in use
+        # is then tried and their symbols merged, and only a frame with a new
+        # code counts as a hit, so easy labels read by the raw tier do not stop
+        # the ladder from reaching the ones that need enhancing.
+        gray = self.to_gray(frame)
+        if self.fixed_tiers:
+            tiers = self.fixed_tiers
+        else:
+            tiers = ["raw"] if self.level == 0 else ["raw", TIERS[self.level]]
+        found = {}
+        found_tier = None
+        for tier in tiers:
+            symbols = self.decode_tier(gray, tier)
+            new = [symbol for symbol in symbols if known is None or symbol["data"] not in known]
+            if new and found_tier is None:
+                found_tier = tier
+            for symbol in symbols:
+                found.setdefault(symbol["data"], symbol)
+            if symbols and known is None:
+                break
+        if found_tier:
+            self.misses = 0
+        else:
+            self.misses += 1
+            if self.misses >= self.misses_per_level and self.level < len(TIERS) - 1:
+                self.level += 1
+                self.misses = 0
+        if known is None and not found_tier:
+            return [], None
+        return list(found.values()), found_tier
+
+    def decode(self, frame):
+        # Returns (codes, tier that found them) or ([], None)
+        symbols, tier = self.decode_symbols(frame)
+        return [symbol["data"] for symbol in symbols], tier
+
+    def stage_times(self):
+        return {tier: times for tier, times in self.timings.items() if times}
+
+    def stats(self):
+        return stage_stats(self.stage_times())
+
+# Region of interest handling: QR codes are located with OpenCV's finder pattern
+# detector on a reduced image, followed from frame to frame by searching around
+# the last region, and decoded from a padded square crop scaled to ROI_SIZE.
+# While a region is tracked, the whole frame is still decoded every
+# FULL_FRAME_EVERY frames, which also covers codes the detector does not know
+# (1D barcodes); without one, every frame is decoded whole.
+ROI_SIZE = 480
+ROI_PADDING = 0.35
+DETECT_WIDTH = 480
+TRACK_MISSES = 3
+FULL_FRAME_EVERY = 5
+
+class RegionDecoder:
+    def __init__(self, full_frame_every=FULL_FRAME_EVERY, **ladder_options):
+        self.full_frame_every = full_frame_every
+        self.detector = cv2.QRCodeDetector()
+        self.frame_ladder = DecodeLadder(**ladder_options)
+        self.region_ladder = DecodeLadder(**ladder_options)
+        self.region_image = np.empty((ROI_SIZE, ROI_SIZE), dtype=np.uint8)
+        # (x, y, width, height) in frame pixels, read by the preview
+        self.roi = None
+        self.roi_misses = 0
+        self.frames = 0
+        self.detect_times = []
+
+    def search_window(self, gray):
+        # Around the tracked region (three times its size), or the whole frame
+        if self.roi is None:
+            return gray, 0, 0
+        x, y, w, h = self.roi
+        x0, y0 = max(0, x - w), max(0, y - h)
+        x1, y1 = min(gray.shape[1], x + 2 * w), min(gray.shape[0], y + 2 * h)
+        return gray[y0:y1, x0:x1], x0, y0
+
+    def find_region(self, gray):
+        window, offset_x, offset_y = self.search_window(gray)
+        scale = min(1.0, DETECT_WIDTH / window.shape[1])
+        if scale < 1.0:
+            window = cv2.resize(window, (int(window.shape[1] * scale), int(window.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+
+        started = time.perf_counter()
+        found, points = self.detector.detect(window)
+        self.detect_times.append(time.perf_counter() - started)
+        if not found or points is None:
+            return None
+
+        points = points.reshape(-1, 2) / scale + (offset_x, offset_y)
+        (x0, y0), (x1, y1) = points.min(axis=0), points.max(axis=0)
+        side = max(x1 - x0, y1 - y0) * (1 + 2 * ROI_PADDING)
+        cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+        x, y = int(max(0, cx - side / 2)), int(max(0, cy - side / 2))
+        w, h = int(min(gray.shape[1] - x, side)), int(min(gray.shape[0] - y, side))
+        return (x, y, w, h) if w > 8 and h > 8 else None
+
+    def decode(self, frame):
+        # Returns (codes, "region <tier>" or "full <tier>") or ([], None)
+        gray = self.frame_ladder.to_gray(frame)
+        self.frames += 1
+
+        region = self.find_region(gray)
+        if region:
+            self.roi = region
+            self.roi_misses = 0
+        elif self.roi:
+            self.roi_misses += 1
+            if self.roi_misses >= TRACK_MISSES:
+                self.roi = None
+
+        if self.roi:
+            x, y, w, h = self.roi
+            cv2.resize(gray[y:y + h, x:x + w], (ROI_SIZE, ROI_SIZE), dst=self.region_image, interpolation=cv2.INTER_LINEAR)
+            codes, tier = self.region_ladder.decode(self.region_image)
+            if codes:
+                return codes, f"region {tier}"
+
+        # Without a region to follow the whole frame is all there is, so the
+        # ladder gets every frame and escalates as fast as the plain ladder
+        if self.roi is None or (self.frames - 1) % self.full_frame_every == 0:
+            codes, tier = self.frame_ladder.decode(gray)
+            if codes:
+                return codes, f"full {tier}"
+        return [], None
+
+    def stage_times(self):
+        times = {"detect": self.detect_times} if self.detect_times else {}
+        times.update({f"region {tier}": tier_times for tier, tier_times in self.region_ladder.stage_times().items()})
+        times.update({f"full {tier}": tier_times for tier, tier_times in self.frame_ladder.stage_times().items()})
+        return times
+
+    def stats(self):
+        return stage_stats(self.stage_times())
+
+class FrameQueue:
+    # Bounded queue between the capture and decode threads. When the decoder
+    # falls behind the oldest frame is dropped, so it always works on the newest.
+    def __init__(self, maxsize=1):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def put(self, frame):
+        while True:
+            try:
+                self.queue.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+def reading_order(symbols):
+    # Codes top to bottom, then left to right. Codes whose centres are within half
+    # a code height of each other count as one line (a rack row or a sheet row).
+    lines = []
+    for symbol in sorted(symbols, key=lambda symbol: symbol["rect"][1] + symbol["rect"][3] / 2):
+        x, y, w, h = symbol["rect"]
+        if lines and y + h / 2 - lines[-1]["y"] <= h / 2:
+            lines[-1]["codes"].append((x, symbol["data"]))
+        else:
+            lines.append({"y": y + h / 2, "codes": [(x, symbol["data"])]})
+    return [data for line in lines for x, data in sorted(line["codes"])]
+
+class BatchCollector:
+    # Distinct codes seen across the frames of a batch scan. The order comes from
+    # the frame that decoded the most codes at once, since positions from
+    # different frames do not line up once the camera moves; codes never seen in
+    # that frame follow in the order they were found.
+    def __init__(self):
+        self.seen = []
+        self.best = []
+        self.last_new = None
+
+    def add(self, symbols):
+        new = [symbol["data"] for symbol in symbols if symbol["data"] not in self.seen]
+        unique = list({symbol["data"]: symbol for symbol in symbols}.values())
+        if len(unique) > len(self.best):
+            self.best = unique
+        if new:
+            self.seen.extend(dict.fromkeys(new))
+            self.last_new = time.monotonic()
+        return new
+
+    def codes(self):
+        ordered = reading_order(self.best)
+        return ordered + [data for data in self.seen if data not in ordered]
+
+class BarcodeScanner:
+    # Reads frames on one thread and decodes them on another. on_result is called
+    # once, from the decode thread, with
+    #   {"data": str or None, "reason": "found"/"timeout"/"stopped"/"no camera"/
+    #    "open failed"/"capture failed"/"error", "error", "tier", "codes", "stats"}
+    # so GUI callers should hand it to the Tk loop with after().
+    # In batch mode the scan keeps going after the first code and collects every
+    # distinct code ("codes", in reading order) until idle_timeout seconds pass
+    # without a new one, or the scan is stopped.
+    def __init__(self, on_result, camera, timeout=SCAN_TIMEOUT, decoder=None, batch=False, idle_timeout=BATCH_IDLE_TIMEOUT):
+        # camera returns the device index to open, e.g. CameraRegistry.preferred_index
+        self.on_result = on_result
+        self.camera = camera
+        self.timeout = timeout
+        self.batch = batch
+        self.idle_timeout = idle_timeout
+        self.collector = BatchCollector()
+        # Batch scans decode whole frames, which holds every code on a rack
+        self.decoder = decoder or (DecodeLadder() if batch else RegionDecoder())
+        self.frames = FrameQueue()
+        self.stop_event = threading.Event()
+        self.frame_lock = threading.Lock()
+        self.latest = None
+        self.result = None
+        self.captured = 0
+        self.decoded = 0
+        self.decode_time = 0.0
+        self.start_time = None
+
+    def start(self):
+        self.capture_thread = threading.Thread(target=self.capture, daemon=True)
+        self.decode_thread = threading.Thread(target=self.decode, daemon=True)
+        self.capture_thread.start()
+        self.decode_thread.start()
+
+    def stop(self):
+        self.finish(None, "stopped")
+
+    def is_running(self):
+        return not self.stop_event.is_set()
+
+    def latest_frame(self):
+        with self.frame_lock:
+            return self.latest
+
+    def finish(self, data, reason, error=None, tier=None):
+        # The first caller wins; both threads see stop_event and exit
+        with self.frame_lock:
+            if self.result is not None:
+                return
+            self.result = {"data": data, "reason": reason, "error": error, "tier": tier,
+                           "codes": self.collector.codes(), "stats": self.stats()}
+        self.stop_event.set()
+        self.on_result(self.result)
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.start_time, 1e-9) if self.start_time else 1.0
+        return {
+            "capture_fps": self.captured / elapsed,
+            "decode_fps": self.decoded / elapsed,
+            "decode_ms": 1000 * self.decode_time / self.decoded if self.decoded else 0.0,
+            "dropped": self.frames.dropped,
+            "tiers": self.decoder.stats()
+        }
+
+    def capture(self):
+        try:
+            cam_index = self.camera()
+        except Exception as e:
+            self.finish(None, "error", str(e))
+            return
+        if cam_index is None:
+            self.finish(None, "no camera")
+            return
+
+        cap = cv2.VideoCapture(cam_index)
+        try:
+            if not cap.isOpened():
+                self.finish(None, "open failed")
+                return
+            # The timeout and frame rates run from here, not from camera discovery
+            self.start_time = time.monotonic()
+            while not self.stop_event.is_set():
+                ret, frame = cap.read()
+                if not ret:
+                    self.finish(None, "capture failed")
+                    return
+                self.captured += 1
+                with self.frame_lock:
+                    self.latest = frame
+                self.frames.put(frame)
+        finally:
+            cap.release()
+
+    def found_codes(self):
+        with self.frame_lock:
+            return list(self.collector.seen)
+
+    def decode(self):
+        tier = None
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            if self.collector.last_new and now - self.collector.last_new > self.idle_timeout:
+                self.finish(None, "found", tier=tier)
+                return
+            if not self.collector.last_new and self.start_time and now - self.start_time > self.timeout:
+                self.finish(None, "timeout")
+                return
+            frame = self.frames.get(timeout=0.1)
+            if frame is None:
+                continue
+            started = time.perf_counter()
+            try:
+                if self.batch:
+                    with self.frame_lock:
+                        known = set(self.collector.seen)
+                    symbols, frame_tier = self.decoder.decode_symbols(frame, known)
+                    if frame_tier:
+                        tier = frame_tier
+                    if symbols:
+                        with self.frame_lock:
+                            self.collector.add(symbols)
+                    codes = []
+                else:
+                    codes, tier = self.decoder.decode(frame)
+            except Exception as e:
+                self.finish(None, "error", str(e))
+                return
+            self.decode_time += time.perf_counter() - started
+            self.decoded += 1
+            if codes:
+                self.finish(codes[0], "found", tier=tier)
+                return
+
+def format_scan_stats(stats):
+    tiers = ", ".join(f"{tier} {tier_stats['attempts']}x {tier_stats['ms']:.0f} ms" for tier, tier_stats in stats["tiers"].items())
+    return (f"capture {stats['capture_fps']:.1f} fps, decode {stats['decode_fps']:.1f} fps "
+            f"({stats['decode_ms']:.0f} ms/frame), {stats['dropped']} frames skipped; {tiers}")
+
+# Offline benchmark: replays recorded frames through the decoders above, with no
+# camera or display, so preprocessing changes can be compared on real data
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov", ".webm")
+
+VARIANTS = {
+    "region": lambda options: RegionDecoder(**options),
+    "ladder": lambda options: DecodeLadder(**{key: value for key, value in options.items() if key != "full_frame_every"}),
+    "legacy": lambda options: DecodeLadder(tiers=["enhanced 2x"], **{key: value for key, value in options.items() if key != "full_frame_every"}),
+    "raw": lambda options: DecodeLadder(tiers=["raw"])
+}
+
+VARIANT_OPTIONS = {"misses_per_level": int, "full_frame_every": int, "clip_limit": float, "alpha": float, "beta": float, "upscale": float}
+
+def parse_variant(spec):
+    # "ladder" or "ladder:alpha=1.5,beta=10,upscale=3" -> (label, name, options)
+    name, _, option_text = spec.partition(":")
+    if name not in VARIANTS:
+        raise ValueError(f"Unknown variant {name}, expected one of {', '.join(VARIANTS)}")
+    options = {}
+    for item in filter(None, option_text.split(",")):
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key not in VARIANT_OPTIONS:
+            raise ValueError(f"Unknown option {key}, expected one of {', '.join(VARIANT_OPTIONS)}")
+        options[key] = VARIANT_OPTIONS[key](value)
+    return spec, name, options
+
+def find_sequences(corpus_dir):
+    # Each video is a sequence, and so are the still images of each directory
+    # (in name order), like consecutive frames of one scan
+    sequences = []
+    for root, dirs, files in os.walk(corpus_dir):
+        dirs.sort()
+        images = sorted(os.path.join(root, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+        if images:
+            sequences.append({"name": os.path.relpath(root, corpus_dir), "images": images})
+        for name in sorted(files):
+            if name.lower().endswith(VIDEO_EXTENSIONS):
+                sequences.append({"name": os.path.relpath(os.path.join(root, name), corpus_dir), "video": os.path.join(root, name)})
+    return sequences
+
+def sequence_frames(sequence, max_frames=0):
+    # Frames are read lazily so long recordings do not have to fit in memory
+    count = 0
+    if "images" in sequence:
+        for path in sequence["images"]:
+            frame = cv2.imread(path)
+            if frame is None:
+                continue
+            yield frame
+            count += 1
+            if max_frames and count >= max_frames:
+                return
+    else:
+        cap = cv2.VideoCapture(sequence["video"])
+        try:
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    return
+                yield frame
+                count += 1
+                if max_frames and count >= max_frames:
+                    return
+        finally:
+            cap.release()
+
+def percentiles(times):
+    if not times:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0}
+    values = np.percentile(np.array(times) * 1000, [50, 90, 99])
+    return {"p50": float(values[0]), "p90": float(values[1]), "p99": float(values[2])}
+
+def benchmark_variant(sequences, name, options, max_frames=0):
+    # A fresh decoder per sequence, as each live scan gets one
+    frame_times = []
+    stage_times = {}
+    first_decodes = []
+    frames = 0
+    decoded = 0
+    tiers = {}
+    codes = {}
+    for sequence in sequences:
+        decoder = VARIANTS[name](options)
+        first = None
+        for number, frame in enumerate(sequence_frames(sequence, max_frames), start=1):
+            started = time.perf_counter()
+            found, tier = decoder.decode(frame)
+            frame_times.append(time.perf_counter() - started)
+            frames += 1
+            if found:
+                decoded += 1
+                tiers[tier] = tiers.get(tier, 0) + 1
+                codes.setdefault(sequence["name"], set()).update(found)
+                if first is None:
+                    first = number
+        first_decodes.append(first)
+        for stage, times in decoder.stage_times().items():
+            stage_times.setdefault(stage, []).extend(times)
+
+    reached = [first for first in first_decodes if first is not None]
+    return {
+        "frames": frames,
+        "decoded_frames": decoded,
+        "success_rate": decoded / frames if frames else 0.0,
+        "sequences": len(sequences),
+        "sequences_decoded": len(reached),
+        "median_frames_to_first_decode": float(np.median(reached)) if reached else None,
+        "frame_ms": percentiles(frame_times),
+        "stages": {stage: dict(percentiles(times), attempts=len(times)) for stage, times in stage_times.items()},
+        "tiers": tiers,
+        "codes": {sequence: sorted(found) for sequence, found in codes.items()}
+    }
+
+def run_benchmark(corpus_dir, variant_specs, max_frames=0):
+    sequences = find_sequences(corpus_dir)
+    if not sequences:
+        raise ValueError(f"No images or videos found in {corpus_dir}")
+    report = {"corpus": corpus_dir, "sequences": [sequence["name"] for sequence in sequences], "variants": {}}
+    for spec in variant_specs:
+        label, name, options = parse_variant(spec)
+        report["variants"][label] = benchmark_variant(sequences, name, options, max_frames)
+    return report
+
+def print_benchmark(report):
+    print(f"{report['corpus']}: {len(report['sequences'])} sequences")
+    for label, result in report["variants"].items():
+        first = result["median_frames_to_first_decode"]
+        print(f"\n{label}")
+        print(f"  decoded {result['decoded_frames']}/{result['frames']} frames ({result['success_rate'] * 100:.1f}%), "
+              f"{result['sequences_decoded']}/{result['sequences']} sequences, "
+              f"median frames to first decode {first if first is not None else '-'}")
+        ms = result["frame_ms"]
+        print(f"  per frame: p50 {ms['p50']:.1f} ms, p90 {ms['p90']:.1f} ms, p99 {ms['p99']:.1f} ms")
+        for stage, stage_ms in result["stages"].items():
+            print(f"  {stage:>20}: {stage_ms['attempts']:>6}x  p50 {stage_ms['p50']:.1f} ms, p90 {stage_ms['p90']:.1f} ms, p99 {stage_ms['p99']:.1f} ms")
+        if result["tiers"]:
+            print("  decoded by: " + ", ".join(f"{tier} {count}" for tier, count in sorted(result["tiers"].items())))
+
+def record_frames(output_dir, camera=None, seconds=10.0, every=1):
+    # Build a corpus from the scanning camera: every nth frame for a while
+    index = CameraRegistry().preferred_index() if camera is None else camera
+    if index is None:
+        raise OSError("No camera found")
+    cap = cv2.VideoCapture(index)
+    if not cap.isOpened():
+        raise OSError(f"Could not open camera {index}")
+    os.makedirs(output_dir, exist_ok=True)
+    saved = 0
+    count = 0
+    end = time.monotonic() + seconds
+    try:
+        while time.monotonic() < end:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if count % every == 0:
+                cv2.imwrite(os.path.join(output_dir, f"frame_{saved:05d}.png"), frame)
+                saved += 1
+            count += 1
+    finally:
+        cap.release()
+    return saved
+
+# Photo import: labels photographed in the field are decoded from image files on
+# a process pool, every tier tried in turn as each photo is a single shot
+PHOTO_TIERS = ["raw", "downscaled", "enhanced", "enhanced 2x"]
+# Larger photos skip the upscaled tier, which would not fit the bigger ones in memory
+PHOTO_MAX_UPSCALE_WIDTH = 2000
+PHOTO_BARCODE_NAME = re.compile(r'^(?:barcode|bc)?[ _-]?(\d{1,2})(?:[^\d].*)?$', re.IGNORECASE)
+
+def photo_files(folder):
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.lower().endswith(IMAGE_EXTENSIONS))
+
+def init_photo_worker():
+    # One OpenCV thread per worker process; the pool already uses every core
+    cv2.setNumThreads(1)
+
+def decode_photo(path):
+    # Runs in a worker process. Returns {"path", "codes" (reading order), "tier", "error"}.
+    frame = cv2.imread(path)
+    if frame is None:
+        return {"path": path, "codes": [], "tier": None, "error": "not a readable image"}
+    tiers = PHOTO_TIERS if frame.shape[1] <= PHOTO_MAX_UPSCALE_WIDTH else PHOTO_TIERS[:-1]
+    ladder = DecodeLadder()
+    gray = ladder.to_gray(frame)
+    # Keep going until the MARPLE code turns up, collecting any others on the way
+    symbols = {}
+    found_tier = None
+    for tier in tiers:
+        for symbol in ladder.decode_tier(gray, tier):
+            if symbol["data"] not in symbols:
+                symbols[symbol["data"]] = symbol
+                found_tier = found_tier or tier
+        if any(data.startswith("M") for data in symbols):
+            break
+    return {"path": path, "codes": reading_order(symbols.values()), "tier": found_tier, "error": None}
+
+def decode_photos(paths, workers=None, on_result=None):
+    # Results in the order of paths. Spawned rather than forked, as the GUI
+    # process has threads of its own.
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_photo_worker) as pool:
+        futures = {pool.submit(decode_photo, path): path for path in paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"path": path, "codes": [], "tier": None, "error": str(e)}
+            results[path] = result
+            if on_result:
+                on_result(result)
+    return [results[path] for path in paths]
+
+def photo_barcode(path):
+    # MinKNOW barcode number from names like barcode05.jpg, BC5_label.png or 05.jpg
+    match = PHOTO_BARCODE_NAME.match(os.path.splitext(os.path.basename(path))[0])
+    return format(int(match.group(1)), '02d') if match else None
+
+def photo_codes(result):
+    # (MARPLE code, other code) from one photo; ODK codes do not start with M
+    marple = next((code for code in result["codes"] if code.startswith("M")), None)
+    other = next((code for code in result["codes"] if not code.startswith("M")), None)
+    return marple, other
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MARPLE barcode scanner tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    bench = subparsers.add_parser("bench", help="Replay recorded frames through the decode pipeline")
+    bench.add_argument("corpus_dir", help="Directory of still images (one sequence per directory) and/or videos")
+    bench.add_argument("--variant", action="append", help=f"One of {', '.join(VARIANTS)}, optionally with options, "
+                       "e.g. ladder:alpha=1.5,beta=10,upscale=3,clip_limit=3 (repeat to compare; default region, ladder and legacy)")
+    bench.add_argument("--max-frames", type=int, default=0, help="Frames per sequence (0 for all)")
+    bench.add_argument("--json", help="Also write the full report to this file")
+    bench.add_argument("--min-success", type=float, help="Exit with 1 if any variant decodes fewer than this fraction of frames")
+
+    photos = subparsers.add_parser("photos", help="Decode the codes in a folder of photos")
+    photos.add_argument("folder")
+    photos.add_argument("--workers", type=int, help="Worker processes (default: all cores)")
+
+    record = subparsers.add_parser("record", help="Save frames from the camera as a benchmark sequence")
+    record.add_argument("output_dir")
+    record.add_argument("--camera", type=int, help="Device index (default: the camera scans use)")
+    record.add_argument("--seconds", type=float, default=10.0)
+    record.add_argument("--every", type=int, default=1, help="Keep every nth frame")
+
+    args = parser.parse_args(argv)
+    if args.command == "bench":
+        try:
+            report = run_benchmark(args.corpus_dir, args.variant or ["region", "ladder", "legacy"], args.max_frames)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+        print_benchmark(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+        if args.min_success is not None and any(result["success_rate"] < args.min_success for result in report["variants"].values()):
+            return 1
+    elif args.command == "photos":
+        paths = photo_files(args.folder)
+        started = time.perf_counter()
+        results = decode_photos(paths, args.workers)
+        for result in results:
+            barcode = photo_barcode(result["path"])
+            status = result["error"] or (", ".join(result["codes"]) + f" ({result['tier']})" if result["codes"] else "no code")
+            print(f"{os.path.basename(result['path'])}{f' [barcode{barcode}]' if barcode else ''}: {status}")
+        print(f"Decoded {sum(1 for result in results if result['codes'])}/{len(results)} photos in {time.perf_counter() - started:.1f}s")
+    elif args.command == "record":
+        print(f"Saved {record_frames(args.output_dir, args.camera, args.seconds, args.every)} frames to {args.output_dir}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,485 @@
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import psutil
+import argparse
+import threading
+from collections import deque
+from marple_config import load_config
+from marple_throttle import BASECALLERS
+from marple_transfer import manifest_path
+
+# The textbox keeps the last LOG_LINES lines of a run; the whole run goes to
+# <marpledir>/logs/marple-gui/snakemake-<timestamp>.log
+LOG_LINES = 1000
+DRAIN_INTERVAL = 100
+# The job table shows running jobs and the last TABLE_FINISHED finished ones,
+# refreshed every TABLE_INTERVAL ms
+TABLE_FINISHED = 20
+TABLE_INTERVAL = 1000
+
+def log_dir(marpledir):
+    return os.path.join(marpledir, "logs", "marple-gui")
+
+def new_log_file(marpledir, prefix="snakemake"):
+    os.makedirs(log_dir(marpledir), exist_ok=True)
+    return os.path.join(log_dir(marpledir), f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}.log")
+
+def events_path(log_file):
+    return f"{os.path.splitext(log_file)[0]}.events.jsonl"
+
+def run_history_path(marpledir):
+    return os.path.join(log_dir(marpledir), "runs.jsonl")
+
+# Run modes: "new" targets samples transferred since the last successful "new"
+# or "full" run, "selected" the samples or pathogens named in the GUI, and
+# "full" runs the whole workflow with no targets, as before
+RUN_MODES = ["new", "selected", "full"]
+
+def load_runs(marpledir):
+    try:
+        with open(run_history_path(marpledir), "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except (OSError, ValueError):
+        return []
+
+def record_run(marpledir, run):
+    os.makedirs(log_dir(marpledir), exist_ok=True)
+    with open(run_history_path(marpledir), "a") as f:
+        f.write(json.dumps(run) + "\n")
+
+def last_successful_run(marpledir):
+    # Runs on a hand-picked selection leave other new samples pending
+    runs = [run for run in load_runs(marpledir) if run.get("returncode") == 0 and run.get("mode") in ("new", "full")]
+    return runs[-1] if runs else None
+
+def transferred_at(reads_file):
+    # The transfer rewrites the sample's chunk manifest whenever it changes the
+    # reads. The reads file alone is not enough: a hard-linked sample keeps the
+    # mtime of its MinKNOW chunk.
+    times = []
+    for path in (manifest_path(reads_file), reads_file):
+        try:
+            times.append(os.stat(path).st_mtime)
+        except FileNotFoundError:
+            pass
+    return max(times) if times else None
+
+def workspace_samples(marpledir):
+    # Transferred samples as {"sample", "pathogen", "mtime"}, from reads/<pathogen>/<sample>.fastq.gz;
+    # mtime is when the sample was last transferred
+    samples = []
+    reads_dir = os.path.join(marpledir, "reads")
+    for pathogen in sorted(os.listdir(reads_dir)) if os.path.isdir(reads_dir) else []:
+        pathogen_dir = os.path.join(reads_dir, pathogen)
+        if not os.path.isdir(pathogen_dir):
+            continue
+        for name in sorted(os.listdir(pathogen_dir)):
+            if name.endswith(".fastq.gz") and not name.startswith("."):
+                mtime = transferred_at(os.path.join(pathogen_dir, name))
+                if mtime is None:
+                    continue
+                samples.append({"sample": name[:-len(".fastq.gz")], "pathogen": pathogen, "mtime": mtime})
+    return samples
+
+def select_samples(samples, names):
+    # names are sample names or pathogens, e.g. ["M123", "pst"]
+    wanted = {name.strip().lower() for name in names if name.strip()}
+    return [sample for sample in samples if sample["sample"].lower() in wanted or sample["pathogen"].lower() in wanted]
+
+def run_targets(samples, sample_targets, pathogen_targets):
+    # Snakemake targets for the samples, from the templates in the config:
+    # {sample} and {pathogen} are filled in, relative to the workspace
+    targets = []
+    for sample in samples:
+        targets += [template.format(sample=sample["sample"], pathogen=sample["pathogen"]) for template in sample_targets]
+    for pathogen in sorted({sample["pathogen"] for sample in samples}):
+        targets += [template.format(pathogen=pathogen) for template in pathogen_targets]
+    return list(dict.fromkeys(targets))
+
+def plan_run(marpledir, config, mode="new", names=()):
+    # {"mode", "samples", "targets"}; targets is None for a run of the whole
+    # workflow and empty when there is nothing to run
+    if mode not in RUN_MODES:
+        raise ValueError(f"Unknown run mode: {mode}")
+    samples = workspace_samples(marpledir)
+    if mode == "new":
+        last_run = last_successful_run(marpledir)
+        if last_run is None:
+            # Nothing has been processed yet, so everything is new
+            return {"mode": "full", "samples": [sample["sample"] for sample in samples], "targets": None}
+        samples = [sample for sample in samples if sample["mtime"] >= last_run["started"]]
+    elif mode == "selected":
+        samples = select_samples(samples, names)
+    else:
+        return {"mode": mode, "samples": [sample["sample"] for sample in samples], "targets": None}
+    targets = run_targets(samples, config["run_sample_targets"], config["run_pathogen_targets"])
+    return {"mode": mode, "samples": [sample["sample"] for sample in samples], "targets": targets}
+
+def minknow_live():
+    # A basecaller running means MinKNOW is sequencing
+    try:
+        return any(proc.info["name"] and proc.info["name"].startswith(BASECALLERS) for proc in psutil.process_iter(["name"]))
+    except psutil.Error:
+        return False
+
+def run_profile(config, live=None):
+    # Cores and memory for a run. "auto" sizes --cores and --resources mem_mb
+    # from what is free now, less a reserve for the system and, while a
+    # sequencing run is live, for MinKNOW; cores are also limited to what the
+    # memory can feed, so STAR and bwa jobs are not started only to swap.
+    # "all" is the old --cores all without limits.
+    total_cores = psutil.cpu_count() or 1
+    memory = psutil.virtual_memory()
+    live = minknow_live() if live is None else live
+    profile = {"name": config["run_profile"], "minknow_live": live, "total_cores": total_cores,
+               "total_mem_mb": memory.total // 2 ** 20, "available_mem_mb": memory.available // 2 ** 20}
+    if config["run_profile"] != "auto":
+        return dict(profile, headroom=False, cores=None, mem_mb=None, threads={})
+
+    headroom = bool(config["run_minknow_headroom"] and live)
+    cores = total_cores - (config["minknow_reserve_cores"] if headroom else 0)
+    mem_mb = profile["available_mem_mb"] - config["run_reserve_mb"] - (config["minknow_reserve_mb"] if headroom else 0)
+    mem_mb = max(mem_mb, config["run_min_mem_mb"])
+    if config["run_mb_per_core"]:
+        cores = min(cores, mem_mb // config["run_mb_per_core"])
+    cores = max(1, cores)
+    threads = {rule: max(1, min(int(cap), cores)) for rule, cap in config["run_rule_threads"].items()}
+    return dict(profile, headroom=headroom, cores=cores, mem_mb=mem_mb, threads=threads)
+
+def format_profile(profile):
+    if profile["cores"] is None:
+        return f"all {profile['total_cores']} cores, no memory limit"
+    text = f"{profile['cores']}/{profile['total_cores']} cores, {profile['mem_mb'] / 1024:.1f} GB"
+    if profile["headroom"]:
+        text += ", headroom for MinKNOW"
+    return text
+
+def snakemake_command(targets=None, profile=None):
+    # Targets go first: --set-threads takes every argument that follows it
+    command = ["snakemake"] + list(targets or []) + ["--rerun-incomplete"]
+    if profile is None or profile["cores"] is None:
+        return command + ["--cores", "all"]
+    command += ["--cores", str(profile["cores"]), "--resources", f"mem_mb={profile['mem_mb']}"]
+    if profile["threads"]:
+        command += ["--set-threads"] + [f"{rule}={threads}" for rule, threads in sorted(profile["threads"].items())]
+    return command
+
+def format_runs(runs):
+    # One line per recorded run, to compare throughput between profiles
+    lines = [f"{'Started':<17} {'Mode':<9} {'Samples':>7} {'Cores':>7} {'Mem GB':>7} {'MinKNOW':<8} {'Time':>8} {'s/sample':>9} Status"]
+    for run in runs:
+        profile = run.get("profile") or {}
+        seconds = run["finished"] - run["started"] if run.get("finished") else None
+        samples = len(run.get("samples", []))
+        per_sample = f"{seconds / samples:.0f}" if seconds is not None and samples else "-"
+        cores = profile.get("cores") or "all"
+        mem = f"{profile['mem_mb'] / 1024:.1f}" if profile.get("mem_mb") else "-"
+        live = ("live" if profile.get("minknow_live") else "idle") if profile else "-"
+        status = "ok" if run.get("returncode") == 0 else f"exit {run.get('returncode')}"
+        lines.append(f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(run['started'])):<17} {run['mode']:<9} {samples:>7} "
+                     f"{cores:>7} {mem:>7} {live:<8} {format_duration(seconds):>8} {per_sample:>9} {status}")
+    return "\n".join(lines)
+
+# Lines of the Snakemake job log. A job is announced by a timestamp, a
+# "rule name:" line and indented attributes (jobid, wildcards, threads, ...);
+# Snakemake 8 reports "Finished jobid: 5 (Rule: name)" where 7 says "Finished job 5."
+TIMESTAMP = re.compile(r"^\[(\w{3} \w{3} +\d+ \d\d:\d\d:\d\d \d{4})\]$")
+JOB_HEADER = re.compile(r"^(?:local)?(?:rule|checkpoint) (\S+):$")
+JOB_ERROR = re.compile(r"^Error in rule (\S+):$")
+JOB_ATTRIBUTE = re.compile(r"^\s+(\w+): ?(.*)$")
+# "Finished job 3." before Snakemake 8, "Finished jobid: 3 (Rule: map_reads)" since
+JOB_FINISHED = re.compile(r"^Finished job(?:id:)? (\d+)(?:\.| \(Rule: (\S+)\))?")
+STEPS_DONE = re.compile(r"^(\d+) of (\d+) steps \((\d+(?:\.\d+)?)%\) done")
+
+def parse_wildcards(text):
+    wildcards = {}
+    for item in text.split(", "):
+        key, sep, value = item.partition("=")
+        if sep:
+            wildcards[key.strip()] = value.strip()
+    return wildcards
+
+def job_label(job):
+    return ", ".join(job["wildcards"].values()) or "-"
+
+class SnakemakeProgress:
+    # Turns Snakemake output into events:
+    #   {"event": "job_started", "time", "jobid", "rule", "wildcards", "threads"}
+    #   {"event": "job_finished" or "job_failed", "time", "jobid", "rule", "wildcards", "seconds"}
+    #   {"event": "progress", "time", "done", "total"}
+    # written one JSON object per line to events_file, or kept in self.events
+    # without one. Times come from the timestamps Snakemake prints, so a saved
+    # log parses to the same events. Only running and recently finished jobs
+    # are kept, so a long run costs the GUI no more than a short one.
+    def __init__(self, events_file=None, finished=TABLE_FINISHED):
+        self.lock = threading.Lock()
+        self.file = open(events_file, "w", buffering=1) if events_file else None
+        self.events = []
+        self.jobs = {}
+        self.finished = deque(maxlen=finished)
+        self.done = 0
+        self.total = 0
+        self.start = time.time()
+        self.clock = None
+        self.block = None
+
+    def now(self):
+        return self.clock if self.clock is not None else time.time()
+
+    def feed(self, line):
+        match = TIMESTAMP.match(line)
+        if match:
+            self.end_block()
+            try:
+                self.clock = time.mktime(time.strptime(match.group(1), "%a %b %d %H:%M:%S %Y"))
+            except ValueError:
+                self.clock = None
+            return
+        match = JOB_ATTRIBUTE.match(line)
+        if match and self.block is not None:
+            self.block[match.group(1)] = match.group(2)
+            return
+        self.end_block()
+        match = JOB_HEADER.match(line)
+        if match:
+            self.block = {"event": "job_started", "rule": match.group(1)}
+            return
+        match = JOB_ERROR.match(line)
+        if match:
+            self.block = {"event": "job_failed", "rule": match.group(1)}
+            return
+        match = JOB_FINISHED.match(line)
+        if match:
+            self.end_job("job_finished", match.group(1), match.group(2))
+            return
+        match = STEPS_DONE.match(line)
+        if match:
+            with self.lock:
+                self.done, self.total = int(match.group(1)), int(match.group(2))
+            self.emit({"event": "progress", "time": self.now(), "done": self.done, "total": self.total})
+
+    def end_block(self):
+        block, self.block = self.block, None
+        if block is None or "jobid" not in block:
+            return
+        if block["event"] == "job_failed":
+            self.end_job("job_failed", block["jobid"], block["rule"])
+            return
+        job = {"jobid": block["jobid"], "rule": block["rule"], "wildcards": parse_wildcards(block.get("wildcards", "")),
+               "threads": int(block["threads"]) if block.get("threads", "").isdigit() else None,
+               "start": self.now(), "end": None, "status": "running"}
+        with self.lock:
+            self.jobs[job["jobid"]] = job
+        self.emit({"event": "job_started", "time": job["start"], "jobid": job["jobid"], "rule": job["rule"],
+                   "wildcards": job["wildcards"], "threads": job["threads"]})
+
+    def end_job(self, event, jobid, rule=None):
+        with self.lock:
+            job = self.jobs.pop(jobid, None)
+            if job is None:
+                # A job whose start was not seen, e.g. the log was cut
+                job = {"jobid": jobid, "rule": rule or "", "wildcards": {}, "threads": None,
+                       "start": None, "end": None, "status": "running"}
+            elif rule and not job["rule"]:
+                job["rule"] = rule
+            self.finished.append(job)
+            job["end"] = self.now()
+            job["status"] = "done" if event == "job_finished" else "failed"
+            seconds = job["end"] - job["start"] if job["start"] is not None else None
+        self.emit({"event": event, "time": job["end"], "jobid": jobid, "rule": job["rule"],
+                   "wildcards": job["wildcards"], "seconds": seconds})
+
+    def emit(self, event):
+        if self.file:
+            self.file.write(json.dumps(event) + "\n")
+        else:
+            self.events.append(event)
+
+    def close(self):
+        self.end_block()
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def snapshot(self):
+        # Progress for the GUI, read on its own thread. Jobs still running are
+        # timed against the wall clock.
+        now = time.time()
+        with self.lock:
+            jobs = [dict(job) for job in list(self.finished) + list(self.jobs.values())]
+            done, total = self.done, self.total
+        elapsed = now - self.start
+        fraction = done / total if total else 0.0
+        eta = elapsed / done * (total - done) if done and total > done else None
+        for job in jobs:
+            if job["start"] is None:
+                job["seconds"] = None
+            elif job["end"] is None:
+                job["seconds"] = max(0.0, now - job["start"])
+            else:
+                job["seconds"] = job["end"] - job["start"]
+        return {"done": done, "total": total, "fraction": fraction, "elapsed": elapsed, "eta": eta, "jobs": jobs}
+
+class SnakemakeLog:
+    # Reader threads write each line to the log file and append it to a queue
+    # that holds at most max_lines lines; the GUI drains it on its own thread
+    # with drain(). Lines that are pushed out before a drain are only in the
+    # file, so neither memory nor the cost of a redraw depends on how much the
+    # workflow prints.
+    def __init__(self, log_file, max_lines=LOG_LINES, progress=None):
+        self.log_file = log_file
+        self.max_lines = max_lines
+        self.progress = progress
+        self.queue = deque(maxlen=max_lines)
+        self.lines = deque(maxlen=max_lines)
+        self.file = open(log_file, "w", buffering=1)
+        self.lock = threading.Lock()
+        self.readers = 0
+        self.total = 0
+        self.drained = 0
+
+    def follow(self, *streams):
+        for stream in streams:
+            with self.lock:
+                self.readers += 1
+            threading.Thread(target=self.read, args=(stream,), daemon=True).start()
+
+    def read(self, stream):
+        try:
+            for line in iter(stream.readline, ''):
+                line = line.rstrip("\n")
+                with self.lock:
+                    self.file.write(line + "\n")
+                    self.queue.append(line)
+                    self.total += 1
+                    if self.progress:
+                        self.progress.feed(line)
+        except (OSError, ValueError) as e:
+            with self.lock:
+                self.queue.append(f"Error reading Snakemake output: {e}")
+                self.total += 1
+        finally:
+            stream.close()
+            with self.lock:
+                self.readers -= 1
+                if self.readers == 0:
+                    self.file.close()
+                    if self.progress:
+                        self.progress.close()
+
+    def drain(self):
+        # Lines added since the last call, at most max_lines of them. The
+        # second value is True when older lines were skipped, i.e. the caller
+        # should redraw from self.lines instead of appending.
+        with self.lock:
+            batch, self.queue = self.queue, deque(maxlen=self.max_lines)
+            new = self.total - self.drained
+            self.drained = self.total
+        self.lines.extend(batch)
+        if new >= self.max_lines:
+            return list(self.lines), True
+        return list(batch), False
+
+    def finished(self):
+        with self.lock:
+            return self.readers == 0 and not self.queue
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+def format_run_progress(snapshot):
+    if not snapshot["total"]:
+        return f"Preparing workflow...  elapsed {format_duration(snapshot['elapsed'])}"
+    return (f"{snapshot['done']} of {snapshot['total']} steps ({snapshot['fraction'] * 100:.0f}%)  "
+            f"elapsed {format_duration(snapshot['elapsed'])}  ETA {format_duration(snapshot['eta'])}")
+
+def format_job_table(jobs):
+    # One row per job, running jobs last so they stay in view
+    order = {"done": 0, "failed": 1, "running": 2}
+    lines = [f"{'Rule':<24} {'Sample':<28} {'Status':<8} {'Time':>8}"]
+    for job in sorted(jobs, key=lambda job: (order[job["status"]], job["start"] or 0)):
+        lines.append(f"{job['rule'][:24]:<24} {job_label(job)[:28]:<28} {job['status']:<8} {format_duration(job['seconds']):>8}")
+    return "\n".join(lines)
+
+def load_events(path):
+    # Events from a .events.jsonl file, or parsed from a saved Snakemake log
+    if path.endswith(".jsonl"):
+        with open(path, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    progress = SnakemakeProgress()
+    with open(path, "r", errors="replace") as f:
+        for line in f:
+            progress.feed(line.rstrip("\n"))
+    progress.close()
+    return progress.events
+
+def rule_times(events):
+    # Wall time of finished jobs per rule: {rule: {"jobs", "seconds", "max"}}
+    times = {}
+    for event in events:
+        if event["event"] == "job_finished" and event.get("seconds") is not None:
+            rule = times.setdefault(event["rule"], {"jobs": 0, "seconds": 0.0, "max": 0.0})
+            rule["jobs"] += 1
+            rule["seconds"] += event["seconds"]
+            rule["max"] = max(rule["max"], event["seconds"])
+    return times
+
+def format_rule_times(times):
+    total = sum(rule["seconds"] for rule in times.values()) or 1
+    lines = [f"{'Rule':<28} {'Jobs':>5} {'Total':>9} {'Mean':>8} {'Max':>8} {'Share':>6}"]
+    for name, rule in sorted(times.items(), key=lambda item: -item[1]["seconds"]):
+        lines.append(f"{name[:28]:<28} {rule['jobs']:>5} {format_duration(rule['seconds']):>9} "
+                     f"{format_duration(rule['seconds'] / rule['jobs']):>8} {format_duration(rule['max']):>8} "
+                     f"{rule['seconds'] / total * 100:>5.0f}%")
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MARPLE Snakemake run logs")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    summary = subparsers.add_parser("summary", help="Wall time per rule from run events or Snakemake logs")
+    summary.add_argument("files", nargs="+", help=".events.jsonl files or Snakemake logs")
+    summary.add_argument("--json", action="store_true")
+
+    plan = subparsers.add_parser("plan", help="Show the Snakemake command a run would use")
+    plan.add_argument("--marpledir", default=os.path.join(os.path.expanduser("~"), "marple"))
+    plan.add_argument("--mode", choices=RUN_MODES, default="new")
+    plan.add_argument("names", nargs="*", help="Samples or pathogens for --mode selected")
+
+    runs = subparsers.add_parser("runs", help="List recorded runs with their resource profiles")
+    runs.add_argument("--marpledir", default=os.path.join(os.path.expanduser("~"), "marple"))
+    runs.add_argument("--json", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.command == "summary":
+        events = []
+        for path in args.files:
+            events.extend(load_events(path))
+        times = rule_times(events)
+        print(json.dumps(times, indent=1) if args.json else format_rule_times(times))
+    elif args.command == "plan":
+        config = load_config(args.marpledir)
+        run = plan_run(args.marpledir, config, args.mode, args.names)
+        profile = run_profile(config)
+        print(f"{len(run['samples'])} samples: {', '.join(run['samples'])}")
+        print(f"Resources: {format_profile(profile)}")
+        if run["targets"] == []:
+            print("Nothing to run")
+        else:
+            print(shlex.join(snakemake_command(run["targets"], profile)))
+    elif args.command == "runs":
+        runs = load_runs(args.marpledir)
+        print(json.dumps(runs, indent=1) if args.json else format_runs(runs))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+import time
+import psutil
+import threading
+
+# Processes that compete with transfers during a live run
+BASECALLERS = ("dorado", "dorado_basecall_server", "guppy_basecaller", "guppy_basecall_server", "basecall_server")
+
+# Bounds for the automatic backoff, in bytes per second
+MIN_RATE = 1e6
+MAX_AUTO_RATE = 2e9
+
+def set_idle_io():
+    # On Linux the I/O priority belongs to the calling thread, so this is called
+    # from each transfer worker (and as the process pool initializer)
+    try:
+        psutil.Process(threading.get_native_id()).ionice(psutil.IOPRIO_CLASS_IDLE)
+    except (AttributeError, psutil.Error, OSError):
+        pass
+
+def disk_queue_depth():
+    # Largest number of I/Os in flight on any disk (field 12 of /proc/diskstats)
+    depth = 0
+    try:
+        with open("/proc/diskstats") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 12 or parts[2].startswith(("loop", "ram", "zram")):
+                    continue
+                depth = max(depth, int(parts[11]))
+    except OSError:
+        pass
+    return depth
+
+class IOThrottle:
+    def __init__(self, idle_class=True, max_rate=0, backoff=True, queue_threshold=8, cpu_threshold=300.0, interval=1.0):
+        # max_rate in bytes per second, 0 for no fixed cap. cpu_threshold is the
+        # combined basecaller CPU in percent of one core.
+        self.idle_class = idle_class
+        self.max_rate = max_rate
+        self.backoff = backoff
+        self.queue_threshold = queue_threshold
+        self.cpu_threshold = cpu_threshold
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.rate = max_rate
+        self.next_free = 0.0
+        self.bytes_since_sample = 0
+        self.state = "full speed" if not max_rate else f"capped at {max_rate / 1e6:.0f} MB/s"
+        self.local = threading.local()
+        self.basecallers = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def prepare_thread(self):
+        if self.idle_class and not getattr(self.local, "ready", False):
+            set_idle_io()
+            self.local.ready = True
+
+    def consume(self, nbytes):
+        # Shared by all workers: each block reserves nbytes / rate seconds after the
+        # previous reservation, so together they stay under the rate
+        with self.lock:
+            self.bytes_since_sample += nbytes
+            rate = self.rate
+            if not rate:
+                return
+            now = time.monotonic()
+            self.next_free = max(now, self.next_free) + nbytes / rate
+            delay = self.next_free - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def start(self):
+        if not self.backoff or (self.thread and self.thread.is_alive()):
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.monitor, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def basecaller_cpu(self):
+        # cpu_percent needs the same Process object between calls, so keep them
+        total = 0.0
+        try:
+            for proc in psutil.process_iter(["name"]):
+                if proc.info["name"] and proc.info["name"].startswith(BASECALLERS):
+                    proc = self.basecallers.setdefault(proc.pid, proc)
+                    total += proc.cpu_percent(None)
+        except psutil.Error:
+            pass
+        return total
+
+    def monitor(self):
+        self.basecaller_cpu()
+        while not self.stop_event.wait(self.interval):
+            self.adjust(disk_queue_depth(), self.basecaller_cpu())
+
+    def adjust(self, queue, cpu):
+        reasons = []
+        if queue >= self.queue_threshold:
+            reasons.append(f"disk queue {queue}")
+        if cpu >= self.cpu_threshold:
+            reasons.append(f"basecaller CPU {cpu:.0f}%")
+
+        with self.lock:
+            observed = self.bytes_since_sample / self.interval
+            self.bytes_since_sample = 0
+            if reasons:
+                # Halve quickly while the machine is busy...
+                self.rate = max(MIN_RATE, (self.rate or observed or MAX_AUTO_RATE) / 2)
+                self.state = f"backed off to {self.rate / 1e6:.0f} MB/s ({', '.join(reasons)})"
+            elif self.rate and self.rate != self.max_rate:
+                # ...and recover gradually once it is idle, until the limit no
+                # longer holds transfers back
+                self.rate *= 1.5
+                if self.max_rate and self.rate >= self.max_rate:
+                    self.rate = self.max_rate
+                elif not self.max_rate and (self.rate >= MAX_AUTO_RATE or observed < self.rate / 2):
+                    self.rate = 0
+                if not self.rate:
+                    self.state = "full speed"
+                elif self.rate == self.max_rate:
+                    self.state = f"capped at {self.max_rate / 1e6:.0f} MB/s"
+                else:
+                    self.state = f"recovering, {self.rate / 1e6:.0f} MB/s"
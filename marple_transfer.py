@@ -0,0 +1,805 @@
+import os
+import sys
+import csv
+import time
+import json
+import errno
+import struct
+import shlex
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from marple_config import load_config
+from marple_files import BUFFER_SIZE, file_digest, save_json
+from marple_metadata import METADATA_FIELDS, UPLOAD_DIR, metadata_record, record_samples, compact_metadata
+from marple_throttle import IOThrottle, set_idle_io
+from marple_upload import stage_workspace, format_stage_report
+from marple_minknow import get_experiment_index, stat_chunks, settled_chunks, make_watcher, format_barcode, find_experiment
+from marple_fastq import chunk_read_stats, empty_stats, merge_stats, summarise_stats, load_read_stats, save_read_stats
+from marple_fastq import filter_chunk, empty_filter_summary, merge_filter_summaries
+
+# Bytes handed to the kernel per copy_file_range/sendfile call (also the progress
+# granularity); the user-space fallback reads BUFFER_SIZE at a time
+COPY_BLOCK = 16 * 1024 * 1024
+
+# Errors meaning "this copy method is not supported here", as opposed to a real
+# I/O failure. The next method picks up from the current file offsets.
+FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+# A job is a plain dict, in the same spirit as App.barcode_rows:
+#   {"barcode": "01", "sample": "M123", "pathogen": "Pgt",
+#    "chunks": [{"path", "size", "mtime"}, ...],
+#    "output_file": ".../reads/pgt/M123.fastq.gz",
+#    "rebuild": False}
+# where chunks come from the experiment index (see marple_minknow).
+
+def copy_fd(src_fd, dst_fd, on_bytes=None):
+    # Gzip members can simply be concatenated, so merging chunks is a byte copy.
+    # Keep the bytes in the kernel where possible. Some network and FUSE
+    # filesystems report end of file from copy_file_range or sendfile without
+    # copying anything, so a method that stops short hands over to the next.
+    on_bytes = on_bytes or (lambda n: None)
+    remaining = os.fstat(src_fd).st_size - os.lseek(src_fd, 0, os.SEEK_CUR)
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(src_fd, dst_fd, COPY_BLOCK)
+                if not copied:
+                    break
+                remaining -= copied
+                on_bytes(copied)
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+
+    if remaining > 0 and sys.platform.startswith("linux"):
+        try:
+            while remaining > 0:
+                copied = os.sendfile(dst_fd, src_fd, None, COPY_BLOCK)
+                if not copied:
+                    break
+                remaining -= copied
+                on_bytes(copied)
+        except OSError as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+
+    while remaining > 0:
+        buffer = os.read(src_fd, BUFFER_SIZE)
+        if not buffer:
+            break
+        view = memoryview(buffer)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        remaining -= len(buffer)
+        on_bytes(len(buffer))
+
+    if remaining > 0:
+        raise OSError(errno.EIO, f"source ended {remaining} bytes short of its size")
+
+# Clone ioctls from <linux/fs.h>. On copy-on-write filesystems (btrfs, XFS with
+# reflink, bcachefs) a clone shares the source extents instead of copying bytes.
+FICLONERANGE = 0x4020940d
+# Errors meaning the filesystem pair cannot clone at all; anything else (such as
+# EINVAL for a misaligned range) only rules out this one clone
+REFLINK_UNSUPPORTED_ERRNOS = {errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.ENOTTY, errno.ENOSYS}
+_reflink_unsupported = set()
+
+def reflink_into(src_fd, dst_fd):
+    # Clone all of src onto the end of dst. Returns the bytes cloned, or 0 if the
+    # caller has to copy instead.
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return 0
+    src_st = os.fstat(src_fd)
+    dst_st = os.fstat(dst_fd)
+    if src_st.st_dev != dst_st.st_dev or src_st.st_dev in _reflink_unsupported or not src_st.st_size:
+        return 0
+    # Clones have to start on a block boundary of the destination, so after the
+    # first chunk of a sample they usually only work for block-sized chunks
+    offset = os.lseek(dst_fd, 0, os.SEEK_END)
+    if offset % dst_st.st_blksize:
+        return 0
+    try:
+        fcntl.ioctl(dst_fd, FICLONERANGE, struct.pack("qQQQ", src_fd, 0, 0, offset))
+    except OSError as e:
+        if e.errno in REFLINK_UNSUPPORTED_ERRNOS:
+            _reflink_unsupported.add(src_st.st_dev)
+        return 0
+    os.lseek(dst_fd, offset + src_st.st_size, os.SEEK_SET)
+    return src_st.st_size
+
+def read_umask():
+    # Linux reports the umask in /proc; elsewhere it can only be read by setting
+    # it, which changes it for every thread, so this only runs at import time
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+UMASK = read_umask()
+
+def write_new_file(output_file, write):
+    # Write next to the destination and rename into place, so reads/<pathogen>/
+    # never holds a half-written sample and a failure leaves the old file alone.
+    # write(fd, path) fills the temp file through either of the two.
+    output_dir = os.path.dirname(output_file) or "."
+    os.makedirs(output_dir, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(prefix=f".{os.path.basename(output_file)}.", suffix=".tmp", dir=output_dir)
+    try:
+        write(fd, tmp_file)
+        # mkstemp creates 0600; match what the shell redirection used to create
+        os.fchmod(fd, 0o666 & ~UMASK)
+        os.close(fd)
+        fd = None
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return output_file
+
+def append_to_file(output_file, write):
+    # Add to the end of an existing sample. If anything goes wrong the file is
+    # truncated back so it still matches its manifest.
+    fd = os.open(output_file, os.O_WRONLY)
+    original_size = os.lseek(fd, 0, os.SEEK_END)
+    try:
+        write(fd, output_file)
+    except BaseException:
+        os.ftruncate(fd, original_size)
+        raise
+    finally:
+        os.close(fd)
+
+def copy_paths(paths, fd, on_bytes=None, on_cloned=None):
+    for path in paths:
+        with open(path, "rb") as src:
+            cloned = reflink_into(src.fileno(), fd)
+            if cloned:
+                if on_cloned:
+                    on_cloned(cloned)
+                continue
+            copy_fd(src.fileno(), fd, on_bytes)
+
+def link_chunk(path, output_file):
+    # Hard link a single-chunk sample into place through a temporary name, so an
+    # existing sample is replaced atomically
+    output_dir = os.path.dirname(output_file) or "."
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_file = os.path.join(output_dir, f".{os.path.basename(output_file)}.link.tmp")
+    if os.path.lexists(tmp_file):
+        os.remove(tmp_file)
+    os.link(path, tmp_file)
+    os.replace(tmp_file, output_file)
+
+def concatenate_chunks(paths, output_file, on_bytes=None, on_cloned=None):
+    return write_new_file(output_file, lambda fd, path: copy_paths(paths, fd, on_bytes, on_cloned))
+
+def append_chunks(paths, output_file, on_bytes=None, on_cloned=None):
+    append_to_file(output_file, lambda fd, path: copy_paths(paths, fd, on_bytes, on_cloned))
+
+def try_link_chunk(path, output_file):
+    try:
+        link_chunk(path, output_file)
+        return True
+    except OSError as e:
+        # Different filesystems, or one without hard links: copy instead
+        if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP):
+            return False
+        raise
+
+def filter_chunks(chunks, target_file, filters, summary, pool, on_bytes=None):
+    # One chunk per task so progress moves and the base cap is checked between chunks
+    stats = empty_stats()
+    for chunk in chunks:
+        if summary["capped"]:
+            break
+        remaining = max(filters["max_bases"] - summary["bases_kept"], 1) if filters["max_bases"] else 0
+        part, part_stats = pool.submit(filter_chunk, chunk["path"], target_file, filters["min_length"], filters["min_q"], remaining).result()
+        summary = merge_filter_summaries(summary, part)
+        stats = merge_stats(stats, part_stats)
+        if on_bytes:
+            on_bytes(chunk["size"])
+    return summary, stats
+
+def manifest_path(output_file):
+    # Hidden, so it is not picked up alongside the reads
+    return os.path.join(os.path.dirname(output_file), f".{os.path.basename(output_file)}.manifest.json")
+
+def load_manifest(output_file):
+    try:
+        with open(manifest_path(output_file), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_manifest(output_file, chunks, filters=None, filter_summary=None):
+    st = os.stat(output_file)
+    manifest = {
+        "output_size": st.st_size,
+        "output_mtime": st.st_mtime_ns,
+        "chunks": [{"path": chunk["path"], "size": chunk["size"], "mtime": chunk["mtime"]} for chunk in chunks],
+        # What filtering (if any) produced the file, and what it kept and dropped
+        "filters": filters,
+        "filter_summary": filter_summary
+    }
+    save_json(manifest_path(output_file), manifest)
+
+def new_chunks_since(manifest, output_file, chunks, filters=None):
+    # Returns the chunks still to be appended, or None when the output has to be
+    # rebuilt: no manifest, the output was modified behind our back, the filter
+    # settings changed, or a chunk it already contains has since been removed or
+    # rewritten
+    if manifest is None or manifest.get("filters") != filters:
+        return None
+    try:
+        st = os.stat(output_file)
+    except OSError:
+        return None
+    if st.st_size != manifest["output_size"] or st.st_mtime_ns != manifest["output_mtime"]:
+        return None
+
+    current = {chunk["path"]: chunk for chunk in chunks}
+    for chunk in manifest["chunks"]:
+        source = current.get(chunk["path"])
+        if source is None or source["size"] != chunk["size"] or source["mtime"] != chunk["mtime"]:
+            return None
+
+    contained = {chunk["path"] for chunk in manifest["chunks"]}
+    return [chunk for chunk in chunks if chunk["path"] not in contained]
+
+def chunk_keys(chunks):
+    return [(chunk["path"], chunk["size"], chunk["mtime"]) for chunk in chunks]
+
+def transfer_barcode(job, progress=None, pool=None, filters=None, throttle=None, hardlink=False):
+    # pool is a process pool, needed for read statistics and for filtering.
+    # hardlink links single-chunk samples to their chunk instead of copying.
+    output_file = job["output_file"]
+    chunks = stat_chunks(job["chunks"])
+    if not chunks:
+        raise FileNotFoundError("no reads found")
+    manifest = None if job.get("rebuild") else load_manifest(output_file)
+    new_chunks = new_chunks_since(manifest, output_file, chunks, filters)
+
+    if new_chunks is None:
+        mode, to_copy, final_chunks = "rebuilt", chunks, chunks
+    elif new_chunks:
+        mode, to_copy, final_chunks = "appended", new_chunks, manifest["chunks"] + new_chunks
+    else:
+        mode, to_copy, final_chunks = "unchanged", [], manifest["chunks"]
+
+    # A hard-linked sample is the MinKNOW chunk itself, so never append to it
+    if mode == "appended" and os.stat(output_file).st_nlink > 1:
+        mode, to_copy, final_chunks = "rebuilt", chunks, chunks
+
+    # A filtered sample that already hit its base cap takes nothing more, so leave
+    # the file and its manifest alone rather than rewrite them on every pass
+    if filters and mode == "appended" and manifest["filter_summary"]["capped"]:
+        mode, to_copy, final_chunks = "unchanged", [], manifest["chunks"]
+
+    # Saved statistics are reused if they cover exactly what the sample already holds
+    stats = None
+    previous_keys, previous_stats = load_read_stats(output_file) if pool else (None, None)
+    if mode != "rebuilt" and previous_keys == chunk_keys(manifest["chunks"]):
+        stats = previous_stats
+
+    if progress:
+        # Now that we know what is actually going to be copied, correct the estimate
+        progress.set_total(output_file, sum(chunk["size"] for chunk in to_copy))
+
+    def on_bytes(n):
+        if progress:
+            progress.advance(output_file, n)
+        if throttle:
+            throttle.consume(n)
+
+    # Cloned and linked bytes cost no I/O, so they only count towards progress
+    cloned = []
+    def on_cloned(n):
+        cloned.append(n)
+        if progress:
+            progress.advance(output_file, n)
+
+    detail = {"mode": mode, "chunks_added": len(to_copy), "method": "copy" if to_copy else None}
+    if filters:
+        # Filtering reads every record anyway, so the statistics of the kept reads
+        # come out of the same pass
+        summary = empty_filter_summary() if mode == "rebuilt" else manifest["filter_summary"]
+        if mode != "rebuilt" and stats is None:
+            stats = pool.submit(chunk_read_stats, output_file).result()
+        added = {"summary": summary, "stats": empty_stats()}
+        def write(fd, path):
+            added["summary"], added["stats"] = filter_chunks(to_copy, path, filters, summary, pool, on_bytes)
+        if mode == "rebuilt":
+            write_new_file(output_file, write)
+        elif mode == "appended":
+            append_to_file(output_file, write)
+        summary = added["summary"]
+        stats = merge_stats(stats or empty_stats(), added["stats"])
+        if mode != "unchanged":
+            save_manifest(output_file, final_chunks, filters, summary)
+        detail["filter"] = summary
+    else:
+        # Read statistics are worked out on other cores while the bytes are copied
+        stats_futures = []
+        if pool:
+            to_scan = to_copy if stats is not None else final_chunks
+            stats = stats or empty_stats()
+            stats_futures = [pool.submit(chunk_read_stats, chunk["path"]) for chunk in to_scan]
+        if mode == "rebuilt" and hardlink and len(to_copy) == 1 and try_link_chunk(to_copy[0]["path"], output_file):
+            on_cloned(to_copy[0]["size"])
+            detail["method"] = "hardlink"
+        elif mode == "rebuilt":
+            concatenate_chunks([chunk["path"] for chunk in to_copy], output_file, on_bytes, on_cloned)
+        elif mode == "appended":
+            append_chunks([chunk["path"] for chunk in to_copy], output_file, on_bytes, on_cloned)
+        if cloned and detail["method"] == "copy":
+            detail["method"] = "reflink" if sum(cloned) == sum(chunk["size"] for chunk in to_copy) else "partial reflink"
+        if mode != "unchanged":
+            save_manifest(output_file, final_chunks)
+        for future in stats_futures:
+            stats = merge_stats(stats, future.result())
+
+    if pool:
+        save_read_stats(output_file, final_chunks, stats)
+        detail["stats"] = summarise_stats(stats)
+    return detail
+
+class TransferProgress:
+    # Byte counters shared by the transfer workers. Workers only add to them; the
+    # GUI reads a snapshot on its own timer, so progress never floods the Tk loop.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = {}
+
+    def add(self, key, total):
+        with self.lock:
+            self.items[key] = {"total": total, "done": 0, "start": None, "end": None}
+
+    def set_total(self, key, total):
+        with self.lock:
+            item = self.items.setdefault(key, {"total": 0, "done": 0, "start": None, "end": None})
+            item["total"] = total
+            item["start"] = item["start"] or time.monotonic()
+
+    def advance(self, key, nbytes):
+        with self.lock:
+            item = self.items[key]
+            item["done"] += nbytes
+            item["start"] = item["start"] or time.monotonic()
+
+    def finish(self, key):
+        with self.lock:
+            item = self.items[key]
+            # Whatever was copied is all there is going to be, also for failures
+            item["total"] = item["done"]
+            item["start"] = item["start"] or time.monotonic()
+            item["end"] = time.monotonic()
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            items = {key: dict(item) for key, item in self.items.items()}
+
+        stats = {key: progress_stats(item["done"], item["total"], item["start"], item["end"] or now) for key, item in items.items()}
+        starts = [item["start"] for item in items.values() if item["start"]]
+        ends = [item["end"] for item in items.values()]
+        overall_end = max(ends) if ends and all(ends) else now
+        overall = progress_stats(sum(item["done"] for item in items.values()), sum(item["total"] for item in items.values()),
+                                 min(starts) if starts else None, overall_end)
+        return {"items": stats, "overall": overall}
+
+def progress_stats(done, total, start, now):
+    elapsed = (now - start) if start else 0
+    rate = done / elapsed if elapsed > 0 else 0
+    fraction = min(done / total, 1.0) if total else (1.0 if start else 0.0)
+    if rate > 0 and total > done:
+        eta = (total - done) / rate
+    else:
+        eta = 0 if start and done >= total else None
+    return {"done": done, "total": total, "fraction": fraction, "rate": rate, "eta": eta}
+
+def format_progress(stats):
+    eta = stats["eta"]
+    eta_text = "--:--" if eta is None else f"{int(eta) // 60}:{int(eta) % 60:02d}"
+    return f"{stats['done'] / 1e6:.1f}/{stats['total'] / 1e6:.1f} MB  {stats['rate'] / 1e6:.1f} MB/s  ETA {eta_text}"
+
+class TransferEngine:
+    def __init__(self, workers=4, read_stats=False, filters=None, throttle=None, hardlink=False):
+        # filters: {"min_length": int, "min_q": float, "max_bases": int} or None
+        # throttle: an IOThrottle to share disk with MinKNOW during a live run
+        self.workers = max(1, int(workers))
+        self.hardlink = hardlink
+        self.read_stats = read_stats
+        self.filters = filters
+        self.throttle = throttle
+        self.process_pool = None
+
+    def get_process_pool(self):
+        # Decompressing is CPU bound, so it gets processes rather than threads.
+        # Spawned rather than forked, as the GUI process has threads of its own.
+        if (self.read_stats or self.filters) and self.process_pool is None:
+            initializer = set_idle_io if self.throttle and self.throttle.idle_class else None
+            self.process_pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"), initializer=initializer)
+        return self.process_pool
+
+    def close(self):
+        if self.process_pool:
+            self.process_pool.shutdown()
+            self.process_pool = None
+        if self.throttle:
+            self.throttle.stop()
+
+    def transfer(self, job, progress, process_pool):
+        if self.throttle:
+            self.throttle.prepare_thread()
+        return transfer_barcode(job, progress, process_pool, self.filters, self.throttle, self.hardlink)
+
+    def run(self, jobs, on_result=None, progress=None):
+        # Barcodes are independent, so they are transferred side by side on a bounded
+        # pool. Failures are collected instead of raised so that one bad barcode does
+        # not stop the others; the caller reports everything together at the end.
+        results = []
+        if not jobs:
+            return results
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(jobs))) as pool:
+            if progress:
+                # Assume full copies until each worker knows what it will append
+                for job in jobs:
+                    progress.add(job["output_file"], sum(chunk["size"] for chunk in job["chunks"]))
+            process_pool = self.get_process_pool()
+            if self.throttle:
+                self.throttle.start()
+            futures = {pool.submit(self.transfer, job, progress, process_pool): job for job in jobs}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    result = {"job": job, "ok": True, "error": None, "detail": future.result()}
+                except Exception as e:
+                    result = {"job": job, "ok": False, "error": str(e), "detail": None}
+                if progress:
+                    progress.finish(job["output_file"])
+                results.append(result)
+                if on_result:
+                    on_result(result)
+
+        # Report in the order the rows were entered
+        order = {id(job): i for i, job in enumerate(jobs)}
+        results.sort(key=lambda result: order[id(result["job"])])
+        return results
+
+# Seconds a chunk has to go untouched before follow mode takes it as finished
+FOLLOW_DEBOUNCE = 5.0
+
+class FollowTransfer:
+    def __init__(self, experiment_dir, jobs, workers=4, debounce=FOLLOW_DEBOUNCE, poll_interval=2.0, on_result=None, read_stats=False, filters=None, throttle=None, hardlink=False, on_error=None):
+        # jobs are the same dicts TransferEngine takes; their chunks are refreshed
+        # from the experiment on every pass. on_error(message) is called from the
+        # follow thread if it stops on an error; the message is also kept in error.
+        self.experiment_dir = experiment_dir
+        self.jobs = jobs
+        self.engine = TransferEngine(workers=workers, read_stats=read_stats, filters=filters, throttle=throttle, hardlink=hardlink)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.on_result = on_result
+        self.on_error = on_error
+        self.error = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        # Chunks (path, size, mtime) already handed to each sample
+        self.transferred = {id(job): set() for job in jobs}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, wait=True):
+        self.stop_event.set()
+        if wait and self.thread:
+            self.thread.join()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def poll_once(self):
+        index = get_experiment_index(self.experiment_dir)
+        pending = []
+        originals = {}
+        for job in self.jobs:
+            chunks = settled_chunks(stat_chunks(index["barcodes"].get(job["barcode"], [])), self.debounce)
+            seen = {(chunk["path"], chunk["size"], chunk["mtime"]) for chunk in chunks}
+            if chunks and seen != self.transferred[id(job)]:
+                pending_job = dict(job, chunks=chunks, rebuild=False)
+                originals[id(pending_job)] = (job, seen)
+                pending.append(pending_job)
+
+        results = self.engine.run(pending, on_result=self.on_result)
+        # Failed barcodes are tried again on the next pass
+        for result in results:
+            job, seen = originals[id(result["job"])]
+            if result["ok"]:
+                self.transferred[id(job)] = seen
+        return index, results
+
+    def run(self):
+        watcher = make_watcher()
+        try:
+            while not self.stop_event.is_set():
+                index, _ = self.poll_once()
+                watcher.watch(index["dir_mtimes"])
+                # Wake on filesystem events, and at least often enough to pick up
+                # chunks once they have settled
+                watcher.wait(min(self.poll_interval, self.debounce))
+        except Exception as e:
+            self.error = f"Follow mode stopped: {e}"
+            if self.on_error:
+                self.on_error(self.error)
+        finally:
+            watcher.close()
+            self.engine.close()
+
+def sample_output_file(marpledir, pathogen, sample):
+    return os.path.join(marpledir, 'reads', pathogen.lower(), f'{sample}.fastq.gz')
+
+def transfer_samples(marpledir, experiment_dir, samples, engine, progress=None, rebuild=False, follow=False, on_result=None, debounce=FOLLOW_DEBOUNCE):
+    # Shared by App.process_reads and the transfer command. samples are dicts with
+    # barcode, sample and pathogen plus the metadata keys in METADATA_FIELDS.
+    # Returns the results and, in follow mode, the jobs to keep following.
+    index = get_experiment_index(experiment_dir)
+    experiment = index["experiment"]
+    jobs = []
+    follow_jobs = []
+    results = []
+    # Output file -> barcode of the first row writing it; jobs run in parallel,
+    # so a second row for the same sample and pathogen would race the first
+    outputs = {}
+    for sample in samples:
+        barcode = format_barcode(sample["barcode"])
+        chunks = index["barcodes"].get(barcode, [])
+        if follow:
+            # MinKNOW may still be writing the newest chunks; the follower picks
+            # them up once they have settled
+            chunks = settled_chunks(stat_chunks(chunks), debounce)
+        job = {
+            "barcode": barcode,
+            "sample": sample["sample"],
+            "pathogen": sample["pathogen"],
+            "chunks": chunks,
+            "output_file": sample_output_file(marpledir, sample["pathogen"], sample["sample"]),
+            "rebuild": rebuild,
+            "metadata": dict(sample, barcode=barcode)
+        }
+        if job["output_file"] in outputs:
+            results.append({"job": job, "ok": False, "detail": None,
+                            "error": f"{job['sample']} ({job['pathogen']}) is already written by barcode{outputs[job['output_file']]}"})
+            continue
+        outputs[job["output_file"]] = barcode
+        if follow:
+            # Barcodes may not have any reads yet early in a run
+            follow_jobs.append(job)
+        if chunks:
+            jobs.append(job)
+        elif not follow:
+            results.append({"job": job, "ok": False, "error": "not found in MinKNOW directory", "detail": None})
+
+    results += engine.run(jobs, on_result=on_result, progress=progress)
+
+    if follow:
+        # Keep the statistics of the first pass, so the rows do not blank out
+        # figures recorded before
+        stats = {id(r["job"]): r["detail"].get("stats") for r in results if r["ok"]}
+        records = [metadata_record(experiment, job["metadata"], stats.get(id(job))) for job in follow_jobs]
+    else:
+        records = [metadata_record(experiment, r["job"]["metadata"], r["detail"].get("stats")) for r in results if r["ok"]]
+    record_samples(marpledir, records)
+    return results, follow_jobs
+
+def read_sample_sheet(path):
+    # CSV or XLSX with a header row using the sample_metadata.csv column names;
+    # Barcode, SampleName and Pathogen are required
+    if path.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        rows = [["" if cell is None else str(cell) for cell in row] for row in workbook.active.iter_rows(values_only=True)]
+        workbook.close()
+    else:
+        with open(path, newline="") as f:
+            rows = list(csv.reader(f))
+
+    if not rows:
+        raise ValueError(f"{path} is empty")
+    header = [column.strip() for column in rows[0]]
+    missing = [column for column in ["Barcode", "SampleName", "Pathogen"] if column not in header]
+    if missing:
+        raise ValueError(f"{path} is missing columns: {', '.join(missing)}")
+
+    samples = []
+    for line_number, row in enumerate(rows[1:], start=2):
+        # Short rows leave their trailing columns empty
+        row = list(row) + [""] * (len(header) - len(row))
+        values = {METADATA_FIELDS[column]: value.strip() for column, value in zip(header, row) if column in METADATA_FIELDS}
+        if not any(values.values()):
+            continue
+        pathogen = values["pathogen"].capitalize()
+        if pathogen not in ("Pgt", "Pst"):
+            raise ValueError(f"{path} line {line_number}: unknown pathogen '{values['pathogen']}'")
+        try:
+            values["barcode"] = format_barcode(values["barcode"])
+        except ValueError:
+            raise ValueError(f"{path} line {line_number}: invalid barcode '{values['barcode']}'")
+        if not values["sample"]:
+            raise ValueError(f"{path} line {line_number}: missing SampleName")
+        values["pathogen"] = pathogen
+        samples.append(values)
+    return samples
+
+def summarise_results(results):
+    succeeded = [r for r in results if r["ok"]]
+    failed = [r for r in results if not r["ok"]]
+    lines = [f"Transferred {len(succeeded)} of {len(results)} barcodes."]
+    modes = [r["detail"]["mode"] for r in succeeded if r.get("detail")]
+    if modes:
+        lines.append(", ".join(f"{modes.count(mode)} {mode}" for mode in ["rebuilt", "appended", "unchanged"] if mode in modes))
+    methods = [r["detail"].get("method") for r in succeeded if r.get("detail")]
+    shared = [method for method in ["hardlink", "reflink", "partial reflink"] if method in methods]
+    if shared:
+        lines.append(", ".join(f"{methods.count(method)} by {method}" for method in shared))
+    for r in failed:
+        lines.append(f"barcode{r['job']['barcode']} ({r['job']['sample']}): {r['error']}")
+    return "\n".join(lines), failed
+
+def benchmark_concatenation(barcode_dir, repeats=3):
+    # Compare the old `cat ... > ...` shell path with concatenate_chunks on one
+    # barcode directory, and check both produce the same bytes
+    paths = sorted(os.path.join(barcode_dir, name) for name in os.listdir(barcode_dir) if name.endswith(".fastq.gz"))
+    if not paths:
+        raise ValueError(f"No .fastq.gz chunks in {barcode_dir}")
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+
+    timings = {"shell": [], "native": []}
+    with tempfile.TemporaryDirectory() as workdir:
+        shell_file = os.path.join(workdir, "shell.fastq.gz")
+        native_file = os.path.join(workdir, "native.fastq.gz")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(f"cat {shlex.quote(barcode_dir)}/*.fastq.gz > {shlex.quote(shell_file)}", shell=True, check=True)
+            timings["shell"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            concatenate_chunks(paths, native_file)
+            timings["native"].append(time.perf_counter() - start)
+
+        identical = file_digest(shell_file) == file_digest(native_file)
+
+    return {"chunks": len(paths), "bytes": total_bytes, "timings": timings, "identical": identical}
+
+def print_benchmark(report):
+    print(f"{report['chunks']} chunks, {report['bytes'] / 1e6:.1f} MB")
+    for method, timings in report["timings"].items():
+        best = min(timings)
+        print(f"{method:>7}: best {best:.3f}s ({report['bytes'] / 1e6 / max(best, 1e-9):.0f} MB/s) over {len(timings)} runs")
+    print(f"Output identical: {report['identical']}")
+
+def make_throttle(config, max_mbps=None, backoff=None):
+    max_mbps = config["io_max_mbps"] if max_mbps is None else max_mbps
+    return IOThrottle(idle_class=config["io_idle_class"], max_rate=max_mbps * 1e6,
+                      backoff=config["io_backoff"] if backoff is None else backoff,
+                      queue_threshold=config["io_queue_threshold"], cpu_threshold=config["io_basecaller_cpu_threshold"])
+
+def run_transfer_command(args):
+    experiment_dir = find_experiment(args.experiment)
+    if experiment_dir is None:
+        print(f"Experiment {args.experiment} not found", file=sys.stderr)
+        return 1
+    try:
+        samples = read_sample_sheet(args.sample_sheet)
+    except (OSError, ValueError) as e:
+        print(f"Error reading sample sheet: {e}", file=sys.stderr)
+        return 1
+
+    config = load_config(args.marpledir)
+    filters = None
+    if args.min_length or args.min_q or args.max_mb:
+        filters = {"min_length": args.min_length, "min_q": args.min_q, "max_bases": int(args.max_mb * 1e6)}
+    throttle = make_throttle(config, max_mbps=args.max_mbps, backoff=not args.no_backoff and config["io_backoff"])
+    engine = TransferEngine(workers=args.workers or config["transfer_workers"], read_stats=args.read_stats, filters=filters, throttle=throttle,
+                            hardlink=args.hardlink or config["transfer_hardlink_single"])
+
+    def report(result):
+        job = result["job"]
+        status = result["detail"]["mode"] if result["ok"] else f"FAILED: {result['error']}"
+        print(f"barcode{job['barcode']} -> {job['output_file']}: {status}", flush=True)
+
+    print(f"Transferring {len(samples)} samples from {experiment_dir}")
+    try:
+        results, _ = transfer_samples(args.marpledir, experiment_dir, samples, engine, rebuild=args.rebuild, on_result=report)
+    finally:
+        engine.close()
+    compact_metadata(args.marpledir)
+    if not args.no_stage:
+        # The reads are in the workspace either way; staging can be redone with
+        # marple_upload.py stage
+        try:
+            print(format_stage_report(stage_workspace(args.marpledir, args.spool, include_reads=config["upload_reads"])))
+        except OSError as e:
+            print(f"Error staging uploads in {args.spool}: {e}", file=sys.stderr)
+    summary, failed = summarise_results(results)
+    print(summary)
+    return 1 if failed else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MARPLE read transfer tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    bench = subparsers.add_parser("bench", help="Benchmark chunk concatenation against shell cat")
+    bench.add_argument("barcode_dir", help="A MinKNOW pass/barcodeNN directory")
+    bench.add_argument("--repeats", type=int, default=3)
+
+    transfer = subparsers.add_parser("transfer", help="Transfer the samples in a sample sheet")
+    transfer.add_argument("experiment", help="Experiment directory, or its name under /var/lib/minknow/data")
+    transfer.add_argument("sample_sheet", help="CSV or XLSX with Barcode, SampleName, Pathogen and optional metadata columns")
+    transfer.add_argument("--marpledir", default=os.path.join(os.path.expanduser("~"), "marple"))
+    transfer.add_argument("--workers", type=int, help="Barcodes transferred at the same time (default from marple-gui.json)")
+    transfer.add_argument("--read-stats", action="store_true", help="Compute read statistics while transferring")
+    transfer.add_argument("--min-length", type=int, default=0)
+    transfer.add_argument("--min-q", type=float, default=0.0)
+    transfer.add_argument("--max-mb", type=float, default=0.0, help="Stop after this many Mb per sample")
+    transfer.add_argument("--rebuild", action="store_true", help="Rebuild samples instead of appending new chunks")
+    transfer.add_argument("--max-mbps", type=float, help="Transfer speed cap in MB/s (default from marple-gui.json, 0 for none)")
+    transfer.add_argument("--hardlink", action="store_true", help="Hard link barcodes that have a single chunk instead of copying")
+    transfer.add_argument("--no-backoff", action="store_true", help="Do not slow down when the disk or basecaller is busy")
+    transfer.add_argument("--spool", default=UPLOAD_DIR, help="Upload spool to stage the workspace in")
+    transfer.add_argument("--no-stage", action="store_true", help="Do not stage the workspace for upload")
+
+    follow = subparsers.add_parser("follow", help="Keep samples up to date while a run is sequencing")
+    follow.add_argument("experiment_dir")
+    follow.add_argument("output_dir")
+    follow.add_argument("samples", nargs="+", metavar="BARCODE=SAMPLE")
+    follow.add_argument("--debounce", type=float, default=FOLLOW_DEBOUNCE)
+    follow.add_argument("--workers", type=int, default=4)
+
+    args = parser.parse_args(argv)
+    if args.command == "bench":
+        report = benchmark_concatenation(args.barcode_dir, repeats=args.repeats)
+        print_benchmark(report)
+        return 0 if report["identical"] else 1
+    elif args.command == "transfer":
+        return run_transfer_command(args)
+    elif args.command == "follow":
+        jobs = []
+        for pair in args.samples:
+            barcode, sample = pair.split("=", 1)
+            jobs.append({"barcode": format(int(barcode.replace("barcode", "")), "02d"), "sample": sample, "pathogen": "",
+                         "chunks": [], "output_file": os.path.join(args.output_dir, f"{sample}.fastq.gz")})
+        report = lambda r: print(f"barcode{r['job']['barcode']} -> {r['job']['output_file']}: {r['detail']['mode'] if r['ok'] else r['error']}")
+        follower = FollowTransfer(args.experiment_dir, jobs, workers=args.workers, debounce=args.debounce, on_result=report)
+        follower.start()
+        try:
+            while follower.is_running():
+                follower.thread.join(1)
+        except KeyboardInterrupt:
+            follower.stop()
+        if follower.error:
+            print(follower.error, file=sys.stderr)
+            return 1
+        return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
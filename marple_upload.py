@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+from marple_files import BUFFER_SIZE, file_digest, save_json
+from marple_metadata import UPLOAD_DIR, metadata_path, metadata_lock, file_lock
+
+# The upload spool mirrors the parts of ~/marple that leave the machine
+# (sample_metadata.csv and reads/<pathogen>/<sample>.fastq.gz) under UPLOAD_DIR,
+# with a manifest of what was staged:
+#   {"files": {"reads/pgt/M123.fastq.gz": {"size", "mtime", "sha256", "staged", "workspace"}}}
+# size and mtime are those of the workspace file when it was staged, so an
+# unchanged workspace is recognised from stat calls alone. workspace is the
+# directory the file came from; a staging only removes its own workspace's files.
+SPOOL_MANIFEST = ".spool-manifest.json"
+SYNC_MANIFEST = ".sync-manifest.json"
+SPOOL_LOCK = ".spool.lock"
+
+# The spool manifest is saved after every batch, so an interrupted staging run
+# keeps what it finished
+STAGE_BATCH_FILES = 16
+STAGE_BATCH_BYTES = 2 * 1024 ** 3
+
+def load_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}}
+
+def workspace_files(marpledir, include_reads=True):
+    # relative path -> absolute path of everything that belongs in the spool
+    files = {}
+    if os.path.exists(metadata_path(marpledir)):
+        files["sample_metadata.csv"] = metadata_path(marpledir)
+    reads_dir = os.path.join(marpledir, "reads")
+    if include_reads and os.path.isdir(reads_dir):
+        for root, dirs, names in os.walk(reads_dir):
+            for name in names:
+                if name.endswith(".fastq.gz") and not name.startswith("."):
+                    path = os.path.join(root, name)
+                    files[os.path.relpath(path, marpledir)] = path
+    return files
+
+def copy_and_hash(src, dst):
+    # One pass over the source: the staged copy and its checksum come from the
+    # same bytes, even if the source is appended to meanwhile
+    digest = hashlib.sha256()
+    size = 0
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with open(src, "rb") as fin, open(f"{dst}.tmp", "wb") as fout:
+        for block in iter(lambda: fin.read(BUFFER_SIZE), b""):
+            digest.update(block)
+            fout.write(block)
+            size += len(block)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(f"{dst}.tmp", dst)
+    return digest.hexdigest(), size
+
+def changed_files(files, manifest):
+    # (relative path, stat) of workspace files whose size or mtime differs from
+    # what was last staged
+    changed = []
+    for rel, path in sorted(files.items()):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entry = manifest["files"].get(rel)
+        if entry is None or entry["size"] != st.st_size or entry["mtime"] != st.st_mtime_ns:
+            changed.append((rel, st))
+    return changed
+
+def stage_workspace(marpledir, spool_dir=UPLOAD_DIR, include_reads=True, on_batch=None):
+    # Copy new and changed workspace files into the spool and drop files that
+    # are gone. Returns {"staged", "touched", "removed", "bytes"}. Stagings are
+    # serialised on the spool's own lock; metadata_lock is only taken while
+    # sample_metadata.csv is copied, so snapshots and runs do not wait for reads.
+    os.makedirs(spool_dir, exist_ok=True)
+    with file_lock(os.path.join(spool_dir, SPOOL_LOCK)):
+        return stage_files(marpledir, spool_dir, include_reads, on_batch)
+
+def stage_copy(marpledir, rel, src, dst):
+    if rel == "sample_metadata.csv":
+        with metadata_lock(marpledir):
+            return copy_and_hash(src, dst)
+    return copy_and_hash(src, dst)
+
+def stage_files(marpledir, spool_dir, include_reads, on_batch):
+    workspace = os.path.abspath(marpledir)
+    manifest_file = os.path.join(spool_dir, SPOOL_MANIFEST)
+    manifest = load_json(manifest_file)
+    files = workspace_files(marpledir, include_reads)
+    report = {"staged": [], "touched": [], "removed": [], "bytes": 0}
+
+    batch_files = 0
+    batch_bytes = 0
+    for rel, st in changed_files(files, manifest):
+        entry = manifest["files"].get(rel)
+        staged_file = os.path.join(spool_dir, rel)
+        if entry and entry["size"] == st.st_size and os.path.exists(staged_file) and file_digest(files[rel]) == entry["sha256"]:
+            # Only the mtime moved (a rewrite with the same bytes)
+            entry["mtime"] = st.st_mtime_ns
+            entry["workspace"] = workspace
+            report["touched"].append(rel)
+            continue
+
+        sha256, size = stage_copy(marpledir, rel, files[rel], staged_file)
+        # If the file grew while it was copied, the copy is shorter than st says,
+        # and the next run sees a different size and stages it again
+        manifest["files"][rel] = {"size": size, "mtime": st.st_mtime_ns if size == st.st_size else 0,
+                                  "sha256": sha256, "staged": time.time(), "workspace": workspace}
+        report["staged"].append(rel)
+        report["bytes"] += size
+        batch_files += 1
+        batch_bytes += size
+        if batch_files >= STAGE_BATCH_FILES or batch_bytes >= STAGE_BATCH_BYTES:
+            save_json(manifest_file, manifest, indent=1)
+            if on_batch:
+                on_batch(report)
+            batch_files = batch_bytes = 0
+
+    for rel in sorted(set(manifest["files"]) - set(files)):
+        if not include_reads and rel != "sample_metadata.csv":
+            continue
+        # Entries from before workspaces were recorded came from this one
+        if manifest["files"][rel].get("workspace", workspace) != workspace:
+            continue
+        del manifest["files"][rel]
+        try:
+            os.remove(os.path.join(spool_dir, rel))
+        except FileNotFoundError:
+            pass
+        report["removed"].append(rel)
+
+    if report["staged"] or report["touched"] or report["removed"] or not os.path.exists(manifest_file):
+        save_json(manifest_file, manifest, indent=1)
+    return report
+
+def sync_spool(spool_dir, remote_dir):
+    # Reference sync agent for a mounted or local remote: copies files whose
+    # checksum differs from what the remote last received, then records the
+    # remote state. Nothing is read from the spool when the manifests agree.
+    # Holds the spool lock, so a staging batch is never shipped half done.
+    with file_lock(os.path.join(spool_dir, SPOOL_LOCK)):
+        return sync_files(spool_dir, remote_dir)
+
+def sync_files(spool_dir, remote_dir):
+    manifest = load_json(os.path.join(spool_dir, SPOOL_MANIFEST))
+    os.makedirs(remote_dir, exist_ok=True)
+    synced_file = os.path.join(remote_dir, SYNC_MANIFEST)
+    synced = load_json(synced_file)
+    report = {"copied": [], "deleted": [], "bytes": 0}
+
+    for rel, entry in sorted(manifest["files"].items()):
+        if synced["files"].get(rel, {}).get("sha256") == entry["sha256"]:
+            continue
+        src = os.path.join(spool_dir, rel)
+        dst = os.path.join(remote_dir, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(src, f"{dst}.tmp")
+        os.replace(f"{dst}.tmp", dst)
+        synced["files"][rel] = {"size": entry["size"], "sha256": entry["sha256"], "synced": time.time()}
+        report["copied"].append(rel)
+        report["bytes"] += entry["size"]
+        # Record progress as it goes, so a dropped connection resumes here
+        save_json(synced_file, synced, indent=1)
+
+    for rel in sorted(set(synced["files"]) - set(manifest["files"])):
+        try:
+            os.remove(os.path.join(remote_dir, rel))
+        except FileNotFoundError:
+            pass
+        del synced["files"][rel]
+        report["deleted"].append(rel)
+    if report["deleted"] or not os.path.exists(synced_file):
+        save_json(synced_file, synced, indent=1)
+    return report
+
+def format_stage_report(report):
+    return (f"Upload spool: {len(report['staged'])} staged ({report['bytes'] / 1e6:.1f} MB), "
+            f"{len(report['touched'])} unchanged after checksum, {len(report['removed'])} removed")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MARPLE upload spool")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    stage = subparsers.add_parser("stage", help="Stage new and changed files from the workspace")
+    stage.add_argument("--marpledir", default=os.path.join(os.path.expanduser("~"), "marple"))
+    stage.add_argument("--spool", default=UPLOAD_DIR)
+    stage.add_argument("--metadata-only", action="store_true", help="Do not stage reads")
+
+    sync = subparsers.add_parser("sync", help="Copy spool changes to a remote directory")
+    sync.add_argument("remote_dir")
+    sync.add_argument("--spool", default=UPLOAD_DIR)
+
+    args = parser.parse_args(argv)
+    if args.command == "stage":
+        print(format_stage_report(stage_workspace(args.marpledir, args.spool, include_reads=not args.metadata_only)))
+    elif args.command == "sync":
+        report = sync_spool(args.spool, args.remote_dir)
+        print(f"Synced {len(report['copied'])} files ({report['bytes'] / 1e6:.1f} MB), deleted {len(report['deleted'])}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())